@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+###############################################################################
+#               nc2atmodat/benchmark_stages.py
+###############################################################################
+#
+# Benchmark of the conversion chain (functions.py) on synthetic MITRAS-like
+# files (create_synthetic_data.py). Each stage of PROCESS_FILE and the final
+# write are timed (wall and CPU time) and the increase of the peak memory is
+# recorded (instrumentation of functions.py). Results are appended to a JSON-lines file, every run is compared
+# against the previous runs of the same preset to detect regressions.
+#
+# usage: python benchmark_stages.py [preset ...]
+#
+#=============================================================================#
+# User Input
+#-----------------------------------------------------------------------------#
+workdir  = '/tmp/nc2atmodat_benchmark/'   # synthetic files, outputs and results
+metadata = 'Metadata_for_atmodat_standard.xlsx'
+results_file = workdir + 'benchmark_results.jsonl'
+
+# presets: grid cells (i, j, k), time steps, number of 3D/4D fields
+presets = {'small'  : {'NI' : 100,  'NJ' : 100,  'NK' : 40, 'NT' : 6,  'N3D' : 2, 'N4D' : 4},
+           'medium' : {'NI' : 400,  'NJ' : 400,  'NK' : 60, 'NT' : 12, 'N3D' : 4, 'N4D' : 6},
+           'large'  : {'NI' : 1000, 'NJ' : 1000, 'NK' : 80, 'NT' : 24, 'N3D' : 6, 'N4D' : 8}}
+run_presets = ['small']   # overwritten by the command line arguments
+orography   = True
+
+# a stage is reported as regression if it is slower than
+# (1 + tolerance) x median of the previous runs (and slower than min_seconds)
+tolerance   = 0.2
+min_seconds = 0.25
+
+settings = {'use_own_REF'      : False,
+            'XREF'             : None,
+            'YREF'             : None,
+            'use_own_ijk'      : False,
+            'ii'               : None,
+            'jj'               : None,
+            'kk'               : None,
+            'use_timestep'     : False,
+            'tt'               : None,
+            'custom_variables' : [],
+            'chunk_MB'         : 16,
+            'memory_MB'        : None,
+            'use_encoding_profiles' : True,
+            'encoding_report'       : False,
+            'output_format'         : 'netcdf',
+            'zarr_to_netcdf'        : False,
+            'projection'            : {'proj' : 'utm', 'zone' : 32, 'ellps' : 'WGS84', 'preserve_units' : False},
+            'cache_dir'             : None,
+            'use_coordinate_cache'  : True}
+#-----------------------------------------------------------------------------#
+# END User Input
+#=============================================================================#
+
+import os
+import sys
+import json
+import resource
+import subprocess
+from datetime import datetime
+
+from functions import *
+from create_synthetic_data import WRITE_SYNTHETIC_FILE
+
+
+def RUN_STAGES(PATH, INFILE, METADATA, SETTINGS):
+    """
+    Run PROCESS_FILE with the instrumentation of functions.py switched on.
+    The caches of the stages are cleared before, the benchmark covers the first file of a batch.
+    OUTPUT: list of dictionaries (stage, wall_s, cpu_s, peak_rss_delta_MB, read_MB, written_MB),
+            last entry 'total' of the whole file (peak_rss_delta_MB: increase of the
+            peak memory during the file, peak_rss_MB: peak memory of the process)
+    """
+    for cache in [grid_profile_cache, projection_cache, transformer_cache, geocoordinates_cache, global_attrs_cache,
+                  variable_registry_cache]:
+        cache.clear()
+
+    PROCESS_FILE(PATH, INFILE, METADATA, dict(SETTINGS, instrumentation=True, instrument_log=None))
+    file_record = INSTRUMENTATION()['file_record']
+    records = [rec for rec in file_record['stages'] if rec['depth'] == 0]
+    total   = {key : file_record[key] for key in ['wall_s', 'cpu_s', 'peak_rss_delta_MB', 'read_MB', 'written_MB']}
+    total.update({'stage' : 'total', 'depth' : 0,
+                  'peak_rss_MB' : round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 1)})
+    return records + [total]
+
+
+def BENCHMARK_PRESET(PRESET):
+    """
+    Create the synthetic file of PRESET (once, reused by later runs) and run the stages.
+    Each preset runs in its own process (see __main__), so that the peak memory
+    of one preset does not hide the one of the next.
+    """
+    infile = 'synthetic_{}{}.nc'.format(PRESET, '_oro' if orography else '')
+    if not os.path.exists(workdir + infile):
+        WRITE_SYNTHETIC_FILE(workdir + infile, OROGRAPHY=orography, **presets[PRESET])
+    return RUN_STAGES(workdir, infile, metadata, settings)
+
+
+def GIT_COMMIT():
+    """
+    Current commit of the repository (None outside of git).
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def READ_RESULTS(RESULTS_FILE):
+    """
+    Read all previous benchmark records (JSON lines).
+    """
+    if not os.path.exists(RESULTS_FILE):
+        return []
+    with open(RESULTS_FILE) as fid:
+        return [json.loads(line) for line in fid if line.strip()]
+
+
+def CHECK_REGRESSIONS(RECORDS, PREVIOUS, TOLERANCE=tolerance, MIN_SECONDS=min_seconds):
+    """
+    Compare the wall time of each stage with the median of the previous runs
+    (same preset and stage). OUTPUT: list of regressed records
+    """
+    import numpy as np
+
+    regressions = []
+    for rec in RECORDS:
+        times = [old['wall_s'] for old in PREVIOUS if old['preset'] == rec['preset'] and old['stage'] == rec['stage']]
+        if not times:
+            continue
+        reference = float(np.median(times))
+        if rec['wall_s'] > MIN_SECONDS and rec['wall_s'] > (1 + TOLERANCE) * reference:
+            rec['reference_s'] = reference
+            regressions.append(rec)
+    return regressions
+
+
+def REPORT_BENCHMARK(RECORDS, REGRESSIONS):
+    """
+    Print the stage table of a benchmark run and the detected regressions.
+    """
+    print('{:8s} {:36s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+          'preset', 'stage', 'wall [s]', 'cpu [s]', 'peak+ [MB]', 'read [MB]', 'write [MB]'))
+    for rec in RECORDS:
+        print('{:8s} {:36s} {:9.3f} {:9.3f} {:9.1f} {:>9} {:>9}'.format(rec['preset'], rec['stage'],
+              rec['wall_s'], rec['cpu_s'], rec['peak_rss_delta_MB'], str(rec['read_MB']), str(rec['written_MB'])))
+    for rec in REGRESSIONS:
+        print('WARNING: REPORT_BENCHMARK: {} {} {:.3f} s, previous runs {:.3f} s'.format(
+              rec['preset'], rec['stage'], rec['wall_s'], rec['reference_s']))
+    if not REGRESSIONS:
+        print('INFO: REPORT_BENCHMARK: no regressions')
+
+
+if __name__ == '__main__':
+    from concurrent.futures import ProcessPoolExecutor
+
+    run_presets = sys.argv[1:] or run_presets
+    for preset in run_presets:
+        if preset not in presets:
+            print('ERROR: unknown preset {}, choose from {}'.format(preset, list(presets)))
+            raise SystemExit(1)
+    os.makedirs(workdir, exist_ok=True)
+
+    run = {'date' : datetime.now().isoformat(timespec='seconds'), 'commit' : GIT_COMMIT(),
+           'host' : os.uname().nodename, 'cpus' : os.cpu_count()}
+    records = []
+    for preset in run_presets:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            for rec in pool.submit(BENCHMARK_PRESET, preset).result():
+                records.append(dict(run, preset=preset, **rec))
+
+    regressions = CHECK_REGRESSIONS(records, READ_RESULTS(results_file))
+    REPORT_BENCHMARK(records, regressions)
+    with open(results_file, 'a') as fid:
+        for rec in records:
+            fid.write(json.dumps(rec) + '\n')
+    print('INFO: results appended to ' + results_file)
+
+
+###############################################################################
+#               nc2atmodat/benchmark_stages.py
+###############################################################################
+#EOF
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+###############################################################################
+#               nc2atmodat/create_synthetic_data.py
+###############################################################################
+#
+# Creates synthetic MITRAS-like netCDF files with the variables expected by
+# process_model_data.py. Used to test and benchmark the processing without
+# real model output (see benchmark_stages.py).
+#
+#=============================================================================#
+# User Input
+#-----------------------------------------------------------------------------#
+outfile = 'synthetic_mitras.nc'
+
+ni, nj, nk = 100, 100, 40   # grid cells incl. boundary cells (i, j, k)
+nt         = 6              # number of time steps
+n3d        = 2              # number of 3D fields (time, j, i)
+n4d        = 4              # number of 4D fields (time, k, j, i)
+nunused    = 2              # number of 4D fields which are not published
+orography  = False          # True: terrain following grid with a hill
+netcdf_format = 'NETCDF4'   # 'NETCDF4' or 'NETCDF3_64BIT'
+#-----------------------------------------------------------------------------#
+# END User Input
+#=============================================================================#
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+
+# published field names (dict_OUTPUT_variables), further fields get generic names
+fields_3d = ['tbuisurf_p', 'sfcbnets', 'sfcbnetl', 'sfcbinl', 'sfcbgskyl', 'sfcbgroul',
+             'ujstern', 'tjstern', 'qvjstern']
+fields_4d = ['treal', 'rh', 'tkesum', 'qlcsum', 'qlrsum', 'P_total', 'rhosum',
+             'tmrt', 'utci', 'pet', 'pt', 'conc01', 'conc02']
+
+
+def FIELD_NAMES(NAMES, N, PREFIX):
+    """
+    N field names: first from NAMES, then PREFIX01, PREFIX02, ...
+    """
+    names = list(NAMES[:N])
+    names += ['{}{:02d}'.format(PREFIX, n + 1) for n in range(N - len(names))]
+    return names
+
+
+def CREATE_SYNTHETIC_DATASET(NI=100, NJ=100, NK=40, NT=6, N3D=2, N4D=4, NUNUSED=2,
+                             OROGRAPHY=False, DX=10., START='2021-06-01', DT='10min'):
+    """
+    Synthetic dataset with the layout of MITRAS output (m2cdf):
+      dimensions  i, j, k (cell centres incl. boundary cells), iv, jv, kv (staggered, one less)
+      grid        xsmet, ysmet, zsmet, xvmet, yvmet (1D), zvmet (k, j, i), yzsurf (j, i)
+      coordinates lon, lat (j, i) in m relative to the reference point elam, ephi
+      fields      N3D fields (time, j, i), N4D fields (time, k, j, i), wind components on the
+                  staggered grid and NUNUSED fields which are not published.
+    The 1D grid variables have their own dimensions and are two elements shorter
+    than i, j, k (see CROP_DATA, REASSIGN_DIMENSIONS).
+    Fields are dask arrays, large datasets are written chunk by chunk.
+    INPUT: NI, NJ, NK = number of grid cells, NT = number of time steps
+           OROGRAPHY  = True: hill in the centre of the domain (terrain following grid)
+           DX         = grid spacing in m
+    OUTPUT: xarray dataset
+    """
+    x = np.arange(NI) * DX - DX / 2
+    y = np.arange(NJ) * DX - DX / 2
+
+    # vertical grid: stretched levels, interfaces below each cell
+    dz = np.linspace(DX / 2, 2 * DX, NK - 1)
+    zi = np.concatenate([[-dz[0], 0.], np.cumsum(dz)])
+    zc = 0.5 * (zi[1:] + zi[:-1])
+
+    # surface height
+    if OROGRAPHY:
+        radius  = 0.2 * min(x[-1], y[-1])
+        surface = 0.1 * NK * DX * np.exp(-((x[None, :] - x.mean())**2 + (y[:, None] - y.mean())**2) / radius**2)
+    else:
+        surface = np.zeros((NJ, NI))
+
+    # vector grid, last value is not defined in the model output
+    xvmet = x[1:NI-1] - DX / 2
+    yvmet = y[1:NJ-1] - DX / 2
+    xvmet[-1] = np.nan
+    yvmet[-1] = np.nan
+    zvmet = zi[1:NK-1, None, None] + surface[None, :, :]
+
+    lon, lat = np.meshgrid(x, y)
+    time = pd.date_range(START, periods=NT, freq=DT)
+
+    XARR = xr.Dataset(
+        {'xsmet'  : ('nxsmet', x[:NI-2], {'long_name' : 'x position of cell centre', 'units' : 'm'}),
+         'ysmet'  : ('nysmet', y[:NJ-2], {'long_name' : 'y position of cell centre', 'units' : 'm'}),
+         'zsmet'  : ('nzsmet', zc[:NK-2], {'long_name' : 'height of cell centre', 'units' : 'm'}),
+         'xvmet'  : ('nxvmet', xvmet, {'long_name' : 'x position of cell boundary', 'units' : 'm'}),
+         'yvmet'  : ('nyvmet', yvmet, {'long_name' : 'y position of cell boundary', 'units' : 'm'}),
+         'zvmet'  : (('nzvmet', 'j', 'i'), zvmet, {'units' : 'm'}),
+         'yzsurf' : (('j', 'i'), surface, {'long_name' : 'orography height', 'units' : 'm'}),
+         'lon'    : (('j', 'i'), lon, {'units' : 'm'}),
+         'lat'    : (('j', 'i'), lat, {'units' : 'm'}),
+         'elam'   : ((), 9.97, {'units' : 'degrees_east'}),
+         'ephi'   : ((), 53.55, {'units' : 'degrees_north'})},
+        coords={'time' : time})
+
+    # smooth fields with some noise (compressible like model output)
+    chunks = (1, min(NK, 20), min(NJ, 500), min(NI, 500))
+    state  = da.random.RandomState(42)
+
+    def FIELD(SHAPE, CHUNKS, OFFSET):
+        pattern = (np.sin(2 * np.pi * np.arange(SHAPE[-1]) / SHAPE[-1])[None, :] *
+                   np.cos(2 * np.pi * np.arange(SHAPE[-2]) / SHAPE[-2])[:, None])
+        noise = state.standard_normal(SHAPE, chunks=CHUNKS)
+        return (OFFSET + 5 * da.from_array(pattern, chunks=CHUNKS[-2:]) + 0.1 * noise).astype('f4')
+
+    for n, var in enumerate(FIELD_NAMES(fields_3d, N3D, 'field3d_')):
+        XARR[var] = (('time', 'j', 'i'), FIELD((NT, NJ, NI), (1,) + chunks[2:], 280 + n),
+                     {'units' : '1', 'cell_methods' : 'time: point'})
+    for n, var in enumerate(FIELD_NAMES(fields_4d, N4D, 'field4d_')):
+        XARR[var] = (('time', 'k', 'j', 'i'), FIELD((NT, NK, NJ, NI), chunks, 280 + n),
+                     {'units' : '1', 'cell_methods' : 'time: point'})
+    for n in range(NUNUSED):
+        XARR['unused{:02d}'.format(n + 1)] = (('time', 'k', 'j', 'i'), FIELD((NT, NK, NJ, NI), chunks, 0))
+
+    # wind components on the staggered grid
+    XARR['x_wind'] = (('time', 'k', 'j', 'iv'), FIELD((NT, NK, NJ, NI-1), chunks, 0), {'units' : 'm s-1'})
+    XARR['y_wind'] = (('time', 'k', 'jv', 'i'), FIELD((NT, NK, NJ-1, NI), chunks, 0), {'units' : 'm s-1'})
+    XARR['z_wind'] = (('time', 'kv', 'j', 'i'), FIELD((NT, NK-1, NJ, NI), chunks, 0), {'units' : 'm s-1'})
+
+    XARR.attrs = {'Model' : 'synthetic MITRAS', 'Title' : 'synthetic dataset (create_synthetic_data.py)'}
+    return XARR
+
+
+def WRITE_SYNTHETIC_FILE(FILE, NETCDF_FORMAT='NETCDF4', **KWARGS):
+    """
+    Write a synthetic dataset (CREATE_SYNTHETIC_DATASET) to FILE.
+    NETCDF4: compressed, chunked by time step; NETCDF3_64BIT: uncompressed.
+    KWARGS are passed to CREATE_SYNTHETIC_DATASET.
+    """
+    XARR = CREATE_SYNTHETIC_DATASET(**KWARGS)
+    encoding = {}
+    if NETCDF_FORMAT == 'NETCDF4':
+        for var in XARR.data_vars:
+            if XARR[var].ndim >= 3 and 'time' in XARR[var].dims:
+                chunks = [1] + [min(size, 500) for size in XARR[var].shape[1:]]
+                encoding[var] = {'zlib' : True, 'complevel' : 4, 'chunksizes' : tuple(chunks)}
+    XARR.to_netcdf(FILE, format=NETCDF_FORMAT, encoding=encoding, unlimited_dims=['time'])
+    print('INFO: WRITE_SYNTHETIC_FILE: {} written ({} x {} x {}, {} time steps)'.format(
+          FILE, XARR.sizes['i'], XARR.sizes['j'], XARR.sizes['k'], XARR.sizes['time']))
+    return FILE
+
+
+if __name__ == '__main__':
+    WRITE_SYNTHETIC_FILE(outfile, netcdf_format, NI=ni, NJ=nj, NK=nk, NT=nt,
+                         N3D=n3d, N4D=n4d, NUNUSED=nunused, OROGRAPHY=orography)
+
+
+###############################################################################
+#               nc2atmodat/create_synthetic_data.py
+###############################################################################
+#EOF
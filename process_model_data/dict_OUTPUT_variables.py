@@ -20,6 +20,9 @@ how to call a Dictionary:
 Example:
   variable_list['18b_rec'] should return 'elam'
 
+  Patterns (e.g. 'conc*') can be added to variable_patterns,
+  variables which should never be written to variable_exclusions.
+
 -------------------------------------------------------------------------------
 Adding new variables:
 ---------------------
@@ -262,5 +265,22 @@ variable_list ={
 ###############################################################################
 variable_list.update(coordinate_list)
 
+#==============================================================================
+# variable_patterns: all variables matching a pattern are written
+#   shell-style wildcards:  'conc*'  (conc01, conc02, ...), 'tbuisurf_?'
+#   regular expressions:    're:^sfcb(net|in)[ls]$'
+#==============================================================================
+variable_patterns = {
+#'a' : 'conc*',
+}
+
+#==============================================================================
+# variable_exclusions: names or patterns which are never written,
+#   they overrule variable_list, variable_patterns and custom_variables
+#==============================================================================
+variable_exclusions = {
+#'a' : 'tbuisurf_?',
+}
+
 
 
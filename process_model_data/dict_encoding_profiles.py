@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#===============================================
+#   Encoding of the output variables
+#-----------------------------------------------
+# This file defines how variables are written to the netCDF output:
+# compression (zlib, complevel, shuffle), output dtype, _FillValue and chunksizes.
+# Each variable belongs to a class (3D met fields, 2D surface fields,
+# coordinates, bounds), the class profile is used if the variable has
+# no own entry in custom_encoding (Step 2).
+#
+# Keys:
+#   'zlib'       : True/False, compression on/off
+#   'complevel'  : 1 (fast) ... 9 (small files)
+#   'shuffle'    : True/False, byte shuffle before compression
+#   'dtype'      : output dtype, only applied to floating point variables
+#   '_FillValue' : fill value, 'default' = netCDF default of the output dtype,
+#                  None = no fill value
+#   'chunksizes' : tuple, overrides the planned chunksizes (see PLAN_CHUNKS)
+#
+# EXAMPLE:
+#---------------------------------------------------------------------------------------------
+#'my_var' : {'zlib'       : True,
+#            'complevel'  : 6,
+#            'dtype'      : 'float64',
+#            '_FillValue' : -9999.}
+
+#---------------------------------------------------------------------------------------------
+#--- Step 1: profiles for each class of variables
+#----------
+
+# variables with vertical and horizontal dimensions, e.g. treal(time, z, y, x)
+met3d = {'zlib'       : True,
+         'complevel'  : 4,
+         'shuffle'    : True,
+         'dtype'      : 'float32',
+         '_FillValue' : 'default'}
+
+# variables with horizontal dimensions only, e.g. tbuisurf_p(time, y, x)
+surface2d = {'zlib'       : True,
+             'complevel'  : 4,
+             'shuffle'    : True,
+             'dtype'      : 'float32',
+             '_FillValue' : 'default'}
+
+# coordinates (lat, lon, x_utm, ...) keep their precision and have no fill value (CF)
+coordinate = {'zlib'       : True,
+              'complevel'  : 4,
+              'shuffle'    : True,
+              '_FillValue' : None}
+
+# bounds of the coordinates (x_bnds, time_bnds, ...)
+bounds = {'zlib'       : True,
+          'complevel'  : 4,
+          'shuffle'    : True,
+          '_FillValue' : None}
+
+# all other variables (scalars, 1D variables)
+default = {'zlib'       : True,
+           'complevel'  : 4,
+           'shuffle'    : True}
+
+profiles = {'met3d'      : met3d,
+            'surface2d'  : surface2d,
+            'coordinate' : coordinate,
+            'bounds'     : bounds,
+            'default'    : default}
+
+#---------------------------------------------------------------------------------------------
+#--- Step 2: encoding of individual variables (replaces the class profile)
+#----------
+custom_encoding = {#'building_mask' : {'zlib' : True, 'complevel' : 4, 'dtype' : 'int8', '_FillValue' : -127},
+                   # 3D bounds of the terrain following levels (orography): float32 halves the largest bounds variable
+                   'z_bnds' : dict(bounds, dtype='float32'),
+                  }
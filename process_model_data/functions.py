@@ -10,21 +10,197 @@ from pyproj import Proj, CRS
 import pandas as pd
 from datetime import datetime
 import os
+import threading
+import time
+import json
+import functools
 from dask.diagnostics import ProgressBar
 
 #=============================================================
-def READ_FILE(FILE):
+#   Instrumentation of the processing stages
+#=============================================================
+# switched on per file by PROCESS_FILE (SETTINGS['instrumentation']),
+# disabled stages run without any measurement.
+# One state per thread: files prepared ahead (PROCESS_FILES, pipeline) keep their own records
+instrumentation_threads = threading.local()
+
+def INSTRUMENTATION():
+    """
+    Instrumentation state of the current thread: enabled, depth, stages, file_record.
+    """
+    if not hasattr(instrumentation_threads, 'state'):
+        instrumentation_threads.state = {'enabled' : False, 'depth' : 0, 'stages' : [], 'file_record' : None}
+    return instrumentation_threads.state
+
+def PROCESS_COUNTERS():
+    """
+    Wall time, CPU time (all threads), peak resident memory (MB) and bytes
+    read/written by the process (Linux: /proc/self/io, else None).
+    The counters are process-wide: the dask threads which read and write the
+    data are included, but also other threads (e.g. PREPARE_AHEAD).
+    """
+    import resource
+    counters = {'wall' : time.perf_counter(), 'cpu' : time.process_time(),
+                # ru_maxrss is given in kB on Linux
+                'peak_rss' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+                'read' : None, 'written' : None}
+    try:
+        with open('/proc/self/io') as fid:
+            io = dict(line.split(':') for line in fid)
+        counters['read']    = int(io['rchar'])
+        counters['written'] = int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return counters
+
+
+def COUNTER_DIFFERENCE(START, END):
+    """
+    Difference of two PROCESS_COUNTERS as record (seconds, MB).
+    'counters' : 'process' marks cpu_s, peak_rss_delta_MB, read_MB and written_MB
+    as process-wide (all threads).
+    """
+    MB = 1024.**2
+    record = {'counters' : 'process',
+              'wall_s'   : round(END['wall'] - START['wall'], 4),
+              'cpu_s'    : round(END['cpu'] - START['cpu'], 4),
+              'peak_rss_delta_MB' : round(END['peak_rss'] - START['peak_rss'], 1),
+              'read_MB'    : None,
+              'written_MB' : None}
+    if START['read'] is not None and END['read'] is not None:
+        record['read_MB']    = round((END['read'] - START['read']) / MB, 3)
+        record['written_MB'] = round((END['written'] - START['written']) / MB, 3)
+    return record
+
+
+def INSTRUMENT(FUNC):
+    """
+    Decorator for the processing stages: if the instrumentation is enabled,
+    wall time, CPU time, increase of the peak memory and bytes read/written
+    of each call are appended to the stages of the thread (INSTRUMENTATION).
+    Stages called by other stages are recorded with depth > 0.
+    """
+    @functools.wraps(FUNC)
+    def STAGE(*ARGS, **KWARGS):
+        instrumentation = INSTRUMENTATION()
+        if not instrumentation['enabled']:
+            return FUNC(*ARGS, **KWARGS)
+        start = PROCESS_COUNTERS()
+        instrumentation['depth'] += 1
+        try:
+            return FUNC(*ARGS, **KWARGS)
+        finally:
+            instrumentation['depth'] -= 1
+            record = {'stage' : FUNC.__name__, 'depth' : instrumentation['depth']}
+            record.update(COUNTER_DIFFERENCE(start, PROCESS_COUNTERS()))
+            instrumentation['stages'].append(record)
+    return STAGE
+
+
+def BEGIN_FILE_RECORD(SETTINGS):
+    """
+    Switch the instrumentation on/off for the next file (SETTINGS['instrumentation']).
+    OUTPUT: process counters at the start of the file (None if disabled)
+    """
+    instrumentation = INSTRUMENTATION()
+    instrumentation['enabled'] = SETTINGS.get('instrumentation', False)
+    instrumentation['depth']   = 0
+    instrumentation['stages']  = []
+    instrumentation['file_record'] = None
+    return PROCESS_COUNTERS() if instrumentation['enabled'] else None
+
+
+def END_FILE_RECORD(START, INFILE, OUTFILE, SETTINGS):
+    """
+    Collect the stage records of one file, write them as one JSON line
+    to SETTINGS['instrument_log'] (if set) and keep them in INSTRUMENTATION()['file_record'].
+    """
+    if START is None:
+        return None
+    record = {'type' : 'file', 'date' : datetime.now().isoformat(timespec='seconds'),
+              'pid' : os.getpid(), 'file' : INFILE, 'outfile' : OUTFILE}
+    record.update(COUNTER_DIFFERENCE(START, PROCESS_COUNTERS()))
+    instrumentation = INSTRUMENTATION()
+    record['stages'] = instrumentation['stages']
+    instrumentation['file_record'] = record
+    instrumentation['enabled'] = False
+    WRITE_INSTRUMENT_LOG(SETTINGS.get('instrument_log'), record)
+    return record
+
+
+def BATCH_RECORD(RESULTS, SECONDS, SETTINGS, NWORKERS=1):
+    """
+    Summary of a batch (files, failures, runtime, summed CPU time and I/O of the files)
+    written as one JSON line to SETTINGS['instrument_log'].
+    """
+    if not SETTINGS.get('instrumentation', False):
+        return None
+    records = [res['record'] for res in RESULTS if res.get('record')]
+    record  = {'type' : 'batch', 'date' : datetime.now().isoformat(timespec='seconds'),
+               'files' : len(RESULTS), 'failed' : sum(res['status'] != 'done' for res in RESULTS),
+               'workers' : NWORKERS, 'counters' : 'process', 'wall_s' : round(SECONDS, 4)}
+    for key in ['cpu_s', 'read_MB', 'written_MB']:
+        values = [rec[key] for rec in records if rec[key] is not None]
+        record[key] = round(sum(values), 4) if values else None
+    WRITE_INSTRUMENT_LOG(SETTINGS.get('instrument_log'), record)
+    return record
+
+
+def WRITE_INSTRUMENT_LOG(LOGFILE, RECORD):
+    """
+    Append RECORD as JSON line to LOGFILE (None: no log).
+    One write per line, workers of a batch can share the log file.
+    """
+    if not LOGFILE:
+        return
+    with open(LOGFILE, 'a') as fid:
+        fid.write(json.dumps(RECORD) + '\n')
+
+#=============================================================
+# variables required by the processing steps (grid and reference point)
+grid_variables = ['xsmet', 'ysmet', 'zsmet', 'xvmet', 'yvmet', 'zvmet', 'yzsurf',
+                  'lat', 'lon', 'latu', 'lonu', 'latv', 'lonv', 'elam', 'ephi']
+
+@INSTRUMENT
+def READ_FILE(FILE, OWN_VAR_LIST=[], CHUNK_MB=128, MMAP=True):
     """
     read netCDF with xarray. 
+    Only variables needed by the processing steps are opened (see GET_INPUT_VARIABLES),
+    all others are dropped at open time. Data are opened lazily with dask chunks
+    aligned to the chunking in the file (see GET_DISK_CHUNKS).
+    netCDF3 files (classic, 64-bit offset) are memory-mapped (scipy) if MMAP is True.
     INPUT: FILE = filename or path and file
+           OWN_VAR_LIST = custom_variables (User Input)
+           CHUNK_MB = approximate size of one dask chunk in MB
+           MMAP = True/False, memory-map netCDF3 files
     OUTPUT: data = xarray of FILE
     using xarray module
     """
     
     #--- try to open file, if file not found, raises error
     try:
-        XARR = xr.open_dataset(FILE, engine='netcdf4', drop_variables=('nsfccl'))
-        print('INFO: netCDF open')
+        # netCDF3: the data are read from the mapped file, slices (crop) are read
+        # directly from the page cache instead of through the netCDF library
+        engine, kwargs = 'netcdf4', {}
+        if MMAP and INPUT_FORMAT(FILE) in ['NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET']:
+            engine, kwargs = 'scipy', {'mmap' : True}
+            print('INFO: READ_FILE: netCDF3 file, memory-mapped')
+
+        # read the header only: variable names, dimensions and chunking
+        with xr.open_dataset(FILE, engine=engine, decode_cf=False, **kwargs) as header:
+            keep = set(GET_INPUT_VARIABLES(header.variables, OWN_VAR_LIST))
+            drop = [var for var in header.variables
+                    if var not in keep and var not in header.dims]
+            drop.append('nsfccl')
+            chunks = GET_DISK_CHUNKS(header.drop_vars(drop, errors='ignore'), CHUNK_MB)
+
+        XARR = xr.open_dataset(FILE, engine=engine, drop_variables=drop, chunks=chunks, **kwargs)
+        print('INFO: netCDF open, {} variables not required and dropped'.format(len(drop)))
+
+        # small 1D grid variables are kept in memory
+        for var in XARR.variables:
+            if XARR[var].ndim <= 1:
+                XARR[var].load()
         CHECK_REQUIRED_VARIABLES(XARR)
     except FileNotFoundError:
         print('ERROR: NetCDF file not found. Stopping program.')
@@ -32,6 +208,193 @@ def READ_FILE(FILE):
     
     return XARR
 
+
+@INSTRUMENT
+def READ_FILES(PATH, FILES, OWN_VAR_LIST=[], CHUNK_MB=128, MMAP=True, NTHREADS=4):
+    """
+    Open consecutive files of one model run as one dataset, lazily concatenated along time.
+    The files are opened in NTHREADS threads (READ_FILE: header and grid variables),
+    ordered by their first time step and must have identical grids (CHECK_GRIDS).
+    Variables without time dimension are taken from the first file.
+    OUTPUT: data = xarray of all files
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the instrumentation of the threads is off (INSTRUMENTATION), READ_FILES is recorded as a whole
+    with ThreadPoolExecutor(max_workers=max(1, min(NTHREADS, len(FILES)))) as pool:
+        parts = list(pool.map(lambda infile: READ_FILE(PATH + infile, OWN_VAR_LIST, CHUNK_MB, MMAP), FILES))
+
+    order = sorted(range(len(FILES)), key=lambda n: parts[n].time.values[0])
+    parts = [parts[n] for n in order]
+    files = [FILES[n] for n in order]
+    CHECK_GRIDS(parts, files)
+
+    XARR = xr.concat(parts, dim='time', data_vars='minimal', coords='minimal', compat='override',
+                     combine_attrs='override')
+    steps = np.diff(np.asarray(XARR.time.values, dtype='datetime64[ns]'))
+    if np.any(steps <= np.timedelta64(0, 'ns')):
+        print('ERROR: READ_FILES: time steps of the files overlap or are repeated. Stopping program.')
+        raise SystemExit(1)
+    print('INFO: READ_FILES: {} files opened as one run, {} time steps ({} to {})'.format(
+          len(files), XARR.sizes['time'], XARR.time.values[0], XARR.time.values[-1]))
+    return XARR
+
+
+def CHECK_GRIDS(PARTS, FILES):
+    """
+    Check that the files of a run have identical grids: dimension sizes
+    (except time) and values of the grid variables (see grid_variables).
+    """
+    reference = PARTS[0]
+    sizes = {dim : size for dim, size in reference.sizes.items() if dim != 'time'}
+    for part, infile in zip(PARTS[1:], FILES[1:]):
+        differences = [dim for dim in set(sizes) | set(part.sizes)
+                       if dim != 'time' and sizes.get(dim) != part.sizes.get(dim)]
+        for var in grid_variables:
+            if var not in reference.variables and var not in part.variables:
+                continue
+            if (var not in reference.variables or var not in part.variables
+                    or reference[var].shape != part[var].shape
+                    or not np.array_equal(reference[var].values, part[var].values, equal_nan=True)):
+                differences.append(var)
+        if differences:
+            print('ERROR: CHECK_GRIDS: grid of {} differs from {} ({}). Stopping program.'.format(
+                  infile, FILES[0], ', '.join(differences)))
+            raise SystemExit(1)
+    print('INFO: CHECK_GRIDS: {} files on the same grid'.format(len(PARTS)))
+
+
+def INPUT_FORMAT(FILE):
+    """
+    Format of a netCDF file from its first bytes:
+    NETCDF3_CLASSIC, NETCDF3_64BIT_OFFSET, NETCDF3_64BIT_DATA, NETCDF4 (HDF5) or None
+    """
+    with open(FILE, 'rb') as fid:
+        magic = fid.read(4)
+    formats = {b'CDF\x01' : 'NETCDF3_CLASSIC', b'CDF\x02' : 'NETCDF3_64BIT_OFFSET',
+               b'CDF\x05' : 'NETCDF3_64BIT_DATA', b'\x89HDF' : 'NETCDF4'}
+    return formats.get(magic)
+
+
+def GET_INPUT_VARIABLES(VARIABLES, OWN_VAR_LIST=[]):
+    """
+    Names of the variables in VARIABLES the processing needs from the input file:
+    selected output variables (see VARIABLE_REGISTRY) and grid variables.
+    """
+    registry = VARIABLE_REGISTRY(OWN_VAR_LIST)
+    return [var for var in VARIABLES if var in grid_variables or SELECT_VARIABLE(registry, var)[0]]
+
+
+def GET_DISK_CHUNKS(XARR, CHUNK_MB=128):
+    """
+    dask chunks aligned to the chunking of the netCDF file.
+    Each dimension gets the largest chunk size used in the file, then the chunks
+    are enlarged by multiples of the disk chunks (time first) up to CHUNK_MB.
+    Dimensions which are not chunked in the file (contiguous, netCDF3) are read
+    as one chunk, except for time (one time step per chunk).
+    INPUT: XARR = xarray opened without dask
+    OUTPUT: chunks = dictionary {dimension: chunksize}
+    """
+    chunks = {}
+    for var in XARR.variables:
+        chunksizes = XARR[var].encoding.get('chunksizes')
+        if chunksizes is None:
+            continue
+        for dim, size in zip(XARR[var].dims, chunksizes):
+            chunks[dim] = max(chunks.get(dim, 1), size)
+    for dim, size in XARR.sizes.items():
+        if dim not in chunks:
+            chunks[dim] = 1 if dim == 'time' else size
+        chunks[dim] = min(chunks[dim], size)
+
+    # enlarge chunks of the largest variable by multiples of the disk chunks
+    if len(XARR.data_vars) > 0:
+        largest = max(XARR.data_vars, key=lambda var: XARR[var].size)
+        itemsize = XARR[largest].dtype.itemsize
+        dims = sorted(XARR[largest].dims, key=lambda dim: 0 if dim == 'time' else 1)
+        for dim in dims:
+            nbytes = itemsize * np.prod([chunks[d] for d in XARR[largest].dims])
+            while chunks[dim] < XARR.sizes[dim] and 2 * nbytes <= CHUNK_MB * 1024**2:
+                chunks[dim] = min(2 * chunks[dim], XARR.sizes[dim])
+                nbytes = itemsize * np.prod([chunks[d] for d in XARR[largest].dims])
+    return chunks
+
+#=============================================================
+#   Selection of variables (dict_OUTPUT_variables.py, custom_variables)
+#=============================================================
+# compiled registries, key: custom_variables
+variable_registry_cache = {}
+
+def COMPILE_PATTERN(PATTERN):
+    """
+    Regular expression of a variable pattern: 're:<regex>' or shell-style wildcards (conc*).
+    """
+    import re
+    import fnmatch
+
+    if PATTERN.startswith('re:'):
+        return re.compile(PATTERN[3:])
+    return re.compile(fnmatch.translate(PATTERN))
+
+
+def VARIABLE_REGISTRY(OWN_VAR_LIST=[]):
+    """
+    Compile all selection rules once: exact names of variable_list and coordinate_list
+    (dictionary lookup), variable_patterns, variable_exclusions and custom_variables
+    (names or patterns). Every entry keeps the rule it comes from for the report.
+    OUTPUT: registry = dictionary (names, patterns, exclude_names, exclude_patterns, decisions)
+    """
+    key = tuple(OWN_VAR_LIST)
+    if key in variable_registry_cache:
+        return variable_registry_cache[key]
+
+    import dict_OUTPUT_variables as output_dicts
+
+    registry = {'names' : {}, 'patterns' : [], 'exclude_names' : {}, 'exclude_patterns' : [], 'decisions' : {}}
+    # coordinate_list first, variable_list contains the coordinates as well
+    for listname in ['coordinate_list', 'variable_list']:
+        for rec, var in getattr(output_dicts, listname).items():
+            registry['names'].setdefault(var, "{}['{}']".format(listname, rec))
+
+    def add(NAME, RULE, EXCLUDE=False):
+        if any(char in NAME for char in '*?[') or NAME.startswith('re:'):
+            registry['exclude_patterns' if EXCLUDE else 'patterns'].append((COMPILE_PATTERN(NAME), RULE))
+        else:
+            registry['exclude_names' if EXCLUDE else 'names'].setdefault(NAME, RULE)
+
+    for rec, pattern in getattr(output_dicts, 'variable_patterns', {}).items():
+        add(pattern, "variable_patterns['{}'] = '{}'".format(rec, pattern))
+    for name in OWN_VAR_LIST:
+        add(name, "custom_variables '{}'".format(name))
+    for rec, pattern in getattr(output_dicts, 'variable_exclusions', {}).items():
+        add(pattern, "variable_exclusions['{}'] = '{}'".format(rec, pattern), EXCLUDE=True)
+
+    variable_registry_cache[key] = registry
+    return registry
+
+
+def SELECT_VARIABLE(REGISTRY, VAR):
+    """
+    Decision of the registry for one variable, stored for later lookups.
+    OUTPUT: (selected True/False, rule or None)
+    """
+    decision = REGISTRY['decisions'].get(VAR)
+    if decision is not None:
+        return decision
+
+    rule = REGISTRY['exclude_names'].get(VAR)
+    if rule is None:
+        rule = next((rule for regex, rule in REGISTRY['exclude_patterns'] if regex.fullmatch(VAR)), None)
+    if rule is not None:
+        decision = (False, rule)
+    else:
+        rule = REGISTRY['names'].get(VAR)
+        if rule is None:
+            rule = next((rule for regex, rule in REGISTRY['patterns'] if regex.fullmatch(VAR)), None)
+        decision = (rule is not None, rule)
+    REGISTRY['decisions'][VAR] = decision
+    return decision
+
 #=============================================================
 
 def CHECK_REQUIRED_VARIABLES(XARR):
@@ -49,6 +412,7 @@ def CHECK_REQUIRED_VARIABLES(XARR):
         
 #=============================================================
 
+@INSTRUMENT
 def CROP_DATA(DATA, SWITCH, II,JJ,KK):
     """
     User Input: Crop your data to a specific size.
@@ -63,11 +427,19 @@ def CROP_DATA(DATA, SWITCH, II,JJ,KK):
     
     if SWITCH == True:
         try:
-            if 'iv' and 'jv' and 'kv' in list(XARR.dims):
-                XARR = DATA.isel(i=slice(II[0]+1,II[1]-1), iv=slice(II[0], II[1]-1),
-                                 j=slice(JJ[0]+1,JJ[1]-1), jv=slice(JJ[0], JJ[1]-1),
-                                 k=slice(KK[0]+1,KK[1]-1), kv=slice(KK[0], KK[1]-1))
-                print('INFO: crop file to size i={},{}, j={},{}, k={},{}'.format(II[0],II[1], JJ[0],JJ[1], KK[0],KK[1]))
+            ranges = {'i' : II, 'j' : JJ, 'k' : KK}
+            index  = {}
+            for dim, (first, last) in ranges.items():
+                index[dim]       = slice(first+1, last-1)
+                index[dim + 'v'] = slice(first, last-1)
+            # 1D grid variables and zvmet have own dimensions:
+            # xsmet[1:] are the centres of the cells i, xvmet the faces iv (same for j, k)
+            for var, dim in [('xsmet', 'i'), ('xvmet', 'i'), ('ysmet', 'j'), ('yvmet', 'j'),
+                             ('zsmet', 'k'), ('zvmet', 'k')]:
+                if var in DATA.variables:
+                    index[DATA[var].dims[0]] = slice(ranges[dim][0], ranges[dim][1]-1)
+            XARR = DATA.isel({dim : value for dim, value in index.items() if dim in DATA.dims})
+            print('INFO: crop file to size i={},{}, j={},{}, k={},{}'.format(II[0],II[1], JJ[0],JJ[1], KK[0],KK[1]))
         except ValueError:
             print('ERROR: crop file: insert valid range for i,j,k. stopping programm')
             raise SystemExit(1)
@@ -81,6 +453,7 @@ def CROP_DATA(DATA, SWITCH, II,JJ,KK):
     DATA.close()
     return XARR        
 
+@INSTRUMENT
 def CROP_TIME(DATA, SWITCH, TT):
     """
     USER INPUT: Crop data to a specific time frame
@@ -95,29 +468,303 @@ def CROP_TIME(DATA, SWITCH, TT):
             raise SystemExit(1)
 
     else:
+        XARR = DATA
         print('INFO: timesteps not reduced')
     DATA.close()
     return XARR  
 
 
 #=============================================================
-def REASSIGN_VERTICAL_DIMENSIONS(XARR):
+#   Cropping by coordinates (bounding box)
+#=============================================================
+# spatial trees of curvilinear grids, key: grid fingerprint
+spatial_tree_cache = {}
+
+def REFERENCE_POINT(XARR, PROJECTION, SWITCH, XREF, YREF):
+    """
+    Reference point of the model grid in UTM, as in GEOCOORDINATES:
+    own XREF, YREF (SWITCH = True), else elam/ephi of the dataset, else Geomatikum.
+    """
+    if SWITCH == True:
+        return XREF, YREF
+    try:
+        return PROJECTION(float(XARR.elam), float(XARR.ephi), inverse=False)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return 564568.279, 5935921.365
+
+
+def INDEX_RANGE(VALUES, VMIN, VMAX):
+    """
+    First and last index of the sorted VALUES within [VMIN, VMAX] (binary search).
+    """
+    first = int(np.searchsorted(VALUES, VMIN, side='left'))
+    last  = int(np.searchsorted(VALUES, VMAX, side='right')) - 1
+    return first, last
+
+
+def HORIZONTAL_INDEX_RANGE(XARR, XMIN, XMAX, YMIN, YMAX, CURVILINEAR=False):
+    """
+    Index ranges (i, j) of the cells with centres inside a box in model coordinates (m).
+    Rectilinear grids: binary search along the first row/column of lon, lat (model x, y).
+    Curvilinear grids: spatial tree of all cell centres (cached per grid),
+    the index range covers all cells inside the box.
+    OUTPUT: (i_first, i_last), (j_first, j_last)
+    """
+    if not CURVILINEAR:
+        return (INDEX_RANGE(XARR.lon.isel(j=0).values, XMIN, XMAX),
+                INDEX_RANGE(XARR.lat.isel(i=0).values, YMIN, YMAX))
+
+    from scipy.spatial import cKDTree
+
+    fingerprint = GRID_FINGERPRINT(XARR)
+    if fingerprint not in spatial_tree_cache:
+        points = np.column_stack([np.asarray(XARR.lon.values).ravel(), np.asarray(XARR.lat.values).ravel()])
+        spatial_tree_cache[fingerprint] = cKDTree(points)
+    tree = spatial_tree_cache[fingerprint]
+
+    # square around the centre of the box (maximum norm), then the exact box
+    centre = [(XMIN + XMAX) / 2., (YMIN + YMAX) / 2.]
+    found  = np.asarray(tree.query_ball_point(centre, r=max(XMAX - XMIN, YMAX - YMIN) / 2., p=np.inf), dtype=int)
+    points = tree.data[found]
+    found  = found[(points[:, 0] >= XMIN) & (points[:, 0] <= XMAX) & (points[:, 1] >= YMIN) & (points[:, 1] <= YMAX)]
+    if found.size == 0:
+        return (0, -1), (0, -1)
+    jj, ii = np.unravel_index(found, XARR.lon.shape)
+    return (int(ii.min()), int(ii.max())), (int(jj.min()), int(jj.max()))
+
+
+@INSTRUMENT
+def BBOX_TO_INDICES(XARR, BBOX, PROJECTION, SWITCH, XREF, YREF, PROFILE=None):
+    """
+    Crop indices (ii, jj, kk as in the User Input, see CROP_DATA) of a bounding box.
+    Only the grid variables are read, the data are cropped before they are read.
+    INPUT: BBOX = {'crs' : 'utm', 'latlon' or 'model',
+                   'x'   : [xmin, xmax],  (utm/model: m, latlon: longitude)
+                   'y'   : [ymin, ymax],  (utm/model: m, latlon: latitude)
+                   'z'   : [zmin, zmax]}  (height above ground in m, optional)
+           PROJECTION, SWITCH, XREF, YREF = as for GEOCOORDINATES
+    OUTPUT: II, JJ, KK
+    """
+    if PROFILE is None:
+        PROFILE = GRID_PROFILE(XARR)
+    crs = BBOX.get('crs', 'utm')
+    ni, nj, nk = XARR.sizes['i'], XARR.sizes['j'], XARR.sizes['k']
+
+    if 'x' in BBOX and 'y' in BBOX:
+        (xmin, xmax), (ymin, ymax) = sorted(BBOX['x']), sorted(BBOX['y'])
+        if crs == 'latlon':
+            # boundary of the box in UTM, the index range covers the curved edges
+            edge = np.linspace(0, 1, 101)
+            lons = np.concatenate([xmin + (xmax - xmin) * edge, np.full(101, xmax), xmax - (xmax - xmin) * edge, np.full(101, xmin)])
+            lats = np.concatenate([np.full(101, ymin), ymin + (ymax - ymin) * edge, np.full(101, ymax), ymax - (ymax - ymin) * edge])
+            x_utm, y_utm = PROJECTION(lons, lats, inverse=False)
+            xmin, xmax, ymin, ymax = np.min(x_utm), np.max(x_utm), np.min(y_utm), np.max(y_utm)
+        if crs in ['utm', 'latlon']:
+            xref, yref = REFERENCE_POINT(XARR, PROJECTION, SWITCH, XREF, YREF)
+            xmin, xmax, ymin, ymax = xmin - xref, xmax - xref, ymin - yref, ymax - yref
+        irange, jrange = HORIZONTAL_INDEX_RANGE(XARR, xmin, xmax, ymin, ymax, PROFILE.get('curvilinear'))
+    else:
+        irange, jrange = (1, ni - 3), (1, nj - 3)
+
+    if 'z' in BBOX:
+        # zsmet[n] = height of the cell k = n
+        zmin, zmax = sorted(BBOX['z'])
+        krange = INDEX_RANGE(np.asarray(XARR.zsmet.values, 'f8').ravel(), zmin, zmax)
+    else:
+        krange = (1, nk - 3)
+
+    # boundary cells are removed as by the default crop, bounds need 3 cells
+    indices = []
+    for name, (first, last), size in [('i', irange, ni), ('j', jrange, nj), ('k', krange, nk)]:
+        first, last = max(first, 1), min(last, size - 3)
+        if last - first < 2:
+            print('ERROR: BBOX_TO_INDICES: bounding box contains less than 3 cells along {}. Stopping program.'.format(name))
+            raise SystemExit(1)
+        indices.append([first - 1, last + 2])
+    print('INFO: BBOX_TO_INDICES: {} box -> ii={}, jj={}, kk={}'.format(crs, *indices))
+    return indices
+
+
+#=============================================================
+#   Several regions from one read pass
+#=============================================================
+# dimensions of the cells and of the faces (before and after SET_ijk_TO_xyz)
+# and the 1D grid variables with own dimensions, for each axis
+region_dims = {'i' : {'cells' : ['i', 'x'], 'faces' : ['iv', 'xv'], 'grid' : ['xsmet', 'xvmet']},
+               'j' : {'cells' : ['j', 'y'], 'faces' : ['jv', 'yv'], 'grid' : ['ysmet', 'yvmet']},
+               'k' : {'cells' : ['k', 'z'], 'faces' : ['kv'],       'grid' : ['zsmet', 'zvmet']}}
+
+@INSTRUMENT
+def REGION_INDICES(XARR, REGIONS, PROJECTION, SETTINGS):
+    """
+    Crop indices of the named regions and of their union.
+    INPUT: REGIONS = {name : {'ii' : [..], 'jj' : [..], 'kk' : [..]}}  (as use_own_ijk, missing: whole axis)
+                  or {name : {'bbox' : {...}}}                         (as use_own_bbox)
+    OUTPUT: regions = {name : [ii, jj, kk]}, union = [ii, jj, kk] enclosing all regions
+    """
+    sizes   = {'i' : XARR.sizes['i'], 'j' : XARR.sizes['j'], 'k' : XARR.sizes['k']}
+    regions = {}
+    for name, region in REGIONS.items():
+        if 'bbox' in region:
+            regions[name] = BBOX_TO_INDICES(XARR, region['bbox'], PROJECTION, SETTINGS['use_own_REF'],
+                                            SETTINGS['XREF'], SETTINGS['YREF'])
+        else:
+            regions[name] = [list(region.get(axis + axis, [0, sizes[axis] - 1])) for axis in 'ijk']
+        for axis, (first, last) in zip('ijk', regions[name]):
+            # as the default crop: the last cell of the grid is a boundary cell (last <= size - 1)
+            if first < 0 or last > sizes[axis] - 1 or last - first < 5:
+                print('ERROR: REGION_INDICES: region {} {}{}={} is outside of the grid (0 ... {}) or has less than 3 cells. '
+                      'Stopping program.'.format(name, axis, axis, [first, last], sizes[axis] - 1))
+                raise SystemExit(1)
+    union = [[min(regions[name][n][0] for name in regions), max(regions[name][n][1] for name in regions)]
+             for n in range(3)]
+    print('INFO: REGION_INDICES: {} regions, union ii={}, jj={}, kk={}'.format(len(regions), *union))
+    return regions, union
+
+
+def REGION_OWN_DIMS(XARR):
+    """
+    Own dimensions of the 1D grid variables (xsmet, ..., zvmet) of the input, for each axis.
+    """
+    return {axis : [XARR[var].dims[0] for var in region_dims[axis]['grid'] if var in XARR.variables]
+            for axis in region_dims}
+
+
+def REGION_SUBSET(XARR, REGION, UNION, OWN_DIMS):
+    """
+    Cut a region out of the processed union of all regions (CROP_DATA of the union).
+    Region [a, b] (ii, jj, kk) inside the union [A, B]:
+      cells: a-A ... b-A-3, faces and own dimensions of the grid variables: a-A ... b-A-2
+    Bounds and coordinates of the union are sliced, they equal those of the region.
+    """
+    index = {}
+    for axis, (first, last), (ufirst, ulast) in zip('ijk', REGION, UNION):
+        for dim in region_dims[axis]['cells']:
+            index[dim] = slice(first - ufirst, last - ufirst - 2)
+        for dim in region_dims[axis]['faces'] + OWN_DIMS[axis]:
+            index[dim] = slice(first - ufirst, last - ufirst - 1)
+    subset = XARR.isel({dim : value for dim, value in index.items() if dim in XARR.dims})
+    # orography: model levels are counted from the lowest level of the region
+    if 'k' in subset.coords and subset.k.dtype.kind == 'i':
+        subset['k'] = ('k', np.arange(subset.k.size, dtype=subset.k.dtype), subset.k.attrs)
+    return subset
+
+
+#=============================================================
+# grid profiles of the processed domains, key: grid fingerprint
+grid_profile_cache = {}
+
+def GRID_FINGERPRINT(XARR):
+    """
+    Fingerprint of the model grid: dimension sizes and the values of the grid
+    variables (incl. yzsurf and zvmet). Files of the same domain have the same
+    fingerprint, grids which differ in a single value do not.
+    """
+    import hashlib
+
+    sha = hashlib.sha1()
+    sha.update(repr(sorted((dim, size) for dim, size in XARR.sizes.items() if dim != 'time')).encode())
+    for var in grid_variables:
+        if var not in XARR.variables:
+            continue
+        sha.update(var.encode())
+        sha.update(np.ascontiguousarray(XARR[var].values).tobytes())
+    return sha.hexdigest()
+
+
+@INSTRUMENT
+def GRID_PROFILE(XARR):
+    """
+    Properties of the model grid, computed once per dataset and used by
+    REASSIGN_DIMENSIONS, CREATE_BOUNDS and SET_ijk_TO_xyz:
+      orography     = True/False, None if yzsurf is not in the dataset
+      curvilinear   = True if the horizontal grid (lon, lat) is not rectilinear
+      staggered     = staggered dimensions in the dataset (iv, jv, kv)
+      vertical_type = 'height' (no orography), 'model_level' (orography) or None
+      dx, dy, dz    = mean grid spacing in m (None if not available)
+      fingerprint   = see GRID_FINGERPRINT
+    Profiles are cached by the fingerprint, later files of the same domain
+    skip the scans of the grid variables.
+    """
+    fingerprint = GRID_FINGERPRINT(XARR)
+    if fingerprint in grid_profile_cache:
+        print('INFO: GRID_PROFILE: grid profile taken from cache')
+        return dict(grid_profile_cache[fingerprint])
+
+    profile = {'fingerprint' : fingerprint,
+               'staggered'   : [dim for dim in ['iv', 'jv', 'kv'] if dim in XARR.dims]}
+
+    # orography: mean of the surface height
+    if 'yzsurf' in XARR.variables:
+        profile['orography'] = bool(float(XARR.yzsurf.mean()) != 0)
+        profile['vertical_type'] = 'model_level' if profile['orography'] else 'height'
+    else:
+        profile['orography'] = None
+        profile['vertical_type'] = None
+
+    # rectilinear: x does not change along j, y does not change along i
+    try:
+        lon = XARR.lon.isel(j=[0, -1]).values
+        lat = XARR.lat.isel(i=[0, -1]).values
+        profile['curvilinear'] = not (np.allclose(lon[0], lon[-1]) and np.allclose(lat[:, 0], lat[:, -1]))
+    except (AttributeError, KeyError, ValueError, IndexError):
+        profile['curvilinear'] = None
+
+    # grid spacing
+    for key, var in [('dx', 'xsmet'), ('dy', 'ysmet'), ('dz', 'zsmet')]:
+        if var in XARR.variables and XARR[var].ndim == 1 and XARR[var].size > 1:
+            profile[key] = float(np.nanmean(np.diff(XARR[var].values)))
+        else:
+            profile[key] = None
+
+    grid_profile_cache[fingerprint] = profile
+    print('INFO: GRID_PROFILE: orography={}, curvilinear={}, staggered={}'.format(
+          profile['orography'], profile['curvilinear'], profile['staggered']))
+    return dict(profile)
+
+
+#=============================================================
+def VERTICAL_INTERFACES(XARR):
+    """
+    Lower and upper interface height of each grid cell from zvmet(k+1, j, i).
+    The arrays stay lazy if zvmet is a dask array. The shifted levels are cut
+    from chunks of one level, the result has the level chunks of zvmet again
+    (PLAN_CHUNKS starts from the existing chunks).
+    OUTPUT: lower, upper = arrays (k, j, i)
+    """
+    nk = XARR.k.size
+    zvmet = XARR.zvmet.data
+    if not hasattr(zvmet, 'rechunk'):
+        return zvmet[0:nk], zvmet[1:nk+1]
+    levels = min(max(zvmet.chunks[0]), nk)
+    zvmet  = zvmet.rechunk({0: 1})
+    return zvmet[0:nk].rechunk({0: levels}), zvmet[1:nk+1].rechunk({0: levels})
+
+
+#=============================================================
+def REASSIGN_VERTICAL_DIMENSIONS(XARR, PROFILE=None):
     """
     if orography exists in the model domain, k is different for each cell.
     therefore we need level instead of z coordinate.
+    PROFILE = grid profile of the dataset (see GRID_PROFILE)
     """
+    if PROFILE is None:
+        PROFILE = GRID_PROFILE(XARR)
     try:
-        zsurf = XARR.yzsurf
+        if PROFILE['orography'] is None:
+            raise KeyError('yzsurf')
 
         #CASE: no orography:
-        if zsurf.values.mean() == 0:        
-            # create k as variable
+        if PROFILE['orography'] == False:        
+            # create k as variable, values for k from zsmet (shifted by one level),
+            # last level is extrapolated if zsmet does not reach it
+            zval = np.asarray(XARR.zsmet.values, 'f8').ravel()
             kval = np.empty((XARR.k.size), 'f8')
-
-            # get values for k from zsmet:   
-            for i in range(len(kval)):
-                kval[i] = XARR.zsmet[i+1].values.copy()  
-            kval[-1] = kval[-2] + (kval[-2] - kval[-3])
+            kval[:-1] = zval[1:XARR.k.size]
+            if zval.size > XARR.k.size:
+                kval[-1] = zval[XARR.k.size]
+            else:
+                kval[-1] = kval[-2] + (kval[-2] - kval[-3])
 
             # assign as new variables to data
             XARR['k'] = (['k'], kval)
@@ -135,14 +782,10 @@ def REASSIGN_VERTICAL_DIMENSIONS(XARR):
             print('INFO: adding k (1D) to ncfile')     
 
         #CASE: orography! # k = 3D
-        elif zsurf.values.mean() != 0:   
+        elif PROFILE['orography'] == True:   
 
             # create lev as variable
-            kval = np.empty((XARR.k.size), 'i4')
-
-            # get values for level:   
-            for i in range(len(kval)):
-                kval[i] = i  
+            kval = np.arange(XARR.k.size, dtype='i4')
 
             # assign as new variables to data
             XARR['k'] = (['k'], kval)
@@ -157,13 +800,10 @@ def REASSIGN_VERTICAL_DIMENSIONS(XARR):
             print('INFO: adding k (3D) to ncfile') 
         
         
-            # Add 3D zsmet
+            # Add 3D zsmet: centre between the lower and upper cell interface (lazy)
+            lower, upper = VERTICAL_INTERFACES(XARR)
             XARR = XARR.drop_vars("zsmet")
-            zsmet_3D = np.ndarray((XARR.k.size,XARR.j.size, XARR.i.size))
-            #
-            zsmet_3D = XARR.zvmet[0:-1] + 0.5*( XARR.zvmet[1::] - XARR.zvmet[0:-1])
-            #
-            XARR['zsmet'] = (['k', 'j', 'i'], zsmet_3D.data)         
+            XARR['zsmet'] = (['k', 'j', 'i'], lower + 0.5*(upper - lower))
             zsmet_attr = {'long_name' : 'vertical_distance_above_ground',
                           'standard_name' : 'height',
                           'units' : 'm'}
@@ -181,11 +821,15 @@ def REASSIGN_VERTICAL_DIMENSIONS(XARR):
 
 
 
-def SET_ijk_TO_xyz(XARR):
+@INSTRUMENT
+def SET_ijk_TO_xyz(XARR, PROFILE=None):
     """
     WIP: Preparation on how to rename dimensions and coordinates
          from ijk to xyz.. if requested
+    PROFILE = grid profile of the dataset (see GRID_PROFILE)
     """
+    if PROFILE is None:
+        PROFILE = GRID_PROFILE(XARR)
     if 'i' and 'j' in list(XARR.dims):
         
         replace_dims = {'i':'x', 'j':'y'}
@@ -210,8 +854,8 @@ def SET_ijk_TO_xyz(XARR):
         if 'i_bnds' and 'j_bnds' in list(XARR.coords):
             replace_coord = {'i_bnds' : 'x_bnds', 'j_bnds' : 'y_bnds'}
             XARR = XARR.rename(replace_coord)
-            ncid['x'].attrs['bounds'] = 'x_bnds'
-            ncid['y'].attrs['bounds'] = 'y_bnds'
+            XARR['x'].attrs['bounds'] = 'x_bnds'
+            XARR['y'].attrs['bounds'] = 'y_bnds'
             print('INFO: SET_ijk_TO_xyz: x_bnds, y_bnds added')
         else:
             print('INFO: SET_ijk_TO_xyz: i_bnds, j_bnds not assigned.')
@@ -226,7 +870,7 @@ def SET_ijk_TO_xyz(XARR):
 
     try: 
         # MITAS variable for orography height 
-        if XARR.yzsurf.values.mean() == 0:
+        if PROFILE['orography'] == False:
             print('INFO: k will be renamed to z')
             replace_dims = {'k':'z'}
             XARR = XARR.rename_dims(dims_dict=replace_dims)
@@ -243,7 +887,7 @@ def SET_ijk_TO_xyz(XARR):
               'bounds' : 'z_bnds'}
             XARR.z.attrs = z_attr
             
-        elif XARR.yzsurf.values.mean() != 0:
+        elif PROFILE['orography'] == True:
             pass
         
         else:
@@ -257,11 +901,13 @@ def SET_ijk_TO_xyz(XARR):
 
 
 
-def REASSIGN_DIMENSIONS(XARR):
+@INSTRUMENT
+def REASSIGN_DIMENSIONS(XARR, PROFILE=None):
     """
     i,j,k are used as index.
     this function changes i,j,k to coordinates by giving i,j,k values in meters.
     INPUT: XARR = xarray.dataframe 
+           PROFILE = grid profile of the dataset (see GRID_PROFILE)
     OUTPUT: XARR = xarray.dataframe 
     using xarray module
     """
@@ -326,7 +972,7 @@ def REASSIGN_DIMENSIONS(XARR):
         TODO: assignment of 1D & 3D k as z or level 
         --> implemented, but needs testing
         """
-        XARR = REASSIGN_VERTICAL_DIMENSIONS(XARR)
+        XARR = REASSIGN_VERTICAL_DIMENSIONS(XARR, PROFILE)
       
         """
         TODO: how to handle nsfccl. (MITRAS)
@@ -365,40 +1011,59 @@ def ASSIGN_BOUNDS( NETCDF, COORD_NAME, VALUES):
     return NETCDF
 
 
-def CREATE_BOUNDS(XARR):
+@INSTRUMENT
+def CREATE_BOUNDS(XARR, PROFILE=None):
     """
     assign bound variables for coordinate variables.
     Preparation for ASSIGN_BOUNDS Function.
+    PROFILE = grid profile of the dataset (see GRID_PROFILE)
     using xarray module
     """
+    if PROFILE is None:
+        PROFILE = GRID_PROFILE(XARR)
     try:
         # create bounds from vector coordinates.
         # use xymet, yvmet, zvmet as bound values 
         x_bounds = XARR.xvmet
         y_bounds = XARR.yvmet
-        z_bounds = XARR.zvmet[:,0,0]  #--> todo! 2d instead of array
+        z_bounds = XARR.zvmet[:,0,0]  # no orography: all columns are equal
     
-        # replace nan values at last position
-        x_bounds[-1] = x_bounds[-2] + (x_bounds[-2] - x_bounds[-3])
-        y_bounds[-1] = y_bounds[-2] + (y_bounds[-2] - y_bounds[-3])
+        # replace nan values at last position (not inside a cropped domain)
+        if np.isnan(x_bounds[-1]):
+            x_bounds[-1] = x_bounds[-2] + (x_bounds[-2] - x_bounds[-3])
+        if np.isnan(y_bounds[-1]):
+            y_bounds[-1] = y_bounds[-2] + (y_bounds[-2] - y_bounds[-3])
     
         # assign data for bounds
     
         XARR = ASSIGN_BOUNDS(XARR, 'i', x_bounds)
         XARR = ASSIGN_BOUNDS(XARR, 'j', y_bounds)
         
-        if XARR.yzsurf.values.mean() == 0:
+        if PROFILE['orography'] == False:
             XARR = ASSIGN_BOUNDS(XARR, 'k', z_bounds)
             print('INFO: adding i_bnds, j_bnds, k_bnds to ncfile')
         else:
-            print('INFO: adding i_bnds, j_bnds to ncfile')
-
-    except:
-        print('INFO: CREATE_BOUNDS was not executed. This step was skipped')
+            # orography: 3D bounds of zsmet(k, j, i) from zvmet
+            lower, upper = VERTICAL_INTERFACES(XARR)
+            if hasattr(lower, 'rechunk'):
+                import dask.array as da
+                z_bnds = da.stack([lower, upper], axis=-1).rechunk({3: 2})
+            else:
+                z_bnds = np.stack([lower, upper], axis=-1)
+            # written as float32 (custom_encoding in dict_encoding_profiles)
+            XARR['z_bnds'] = (['k', 'j', 'i', 'nv'], z_bnds)
+            if 'zsmet' in XARR.variables and XARR.zsmet.ndim == 3:
+                XARR['zsmet'].attrs['bounds'] = 'z_bnds'
+            print('INFO: adding i_bnds, j_bnds, z_bnds (3D) to ncfile')
+
+    except (AttributeError, KeyError) as error:
+        # grid variables (xvmet, yvmet, zvmet) not in the dataset
+        print('INFO: CREATE_BOUNDS was not executed ({} missing). This step was skipped'.format(error))
     return XARR
 
 
 #=============================================================
+@INSTRUMENT
 def ADD_TIME_ATTRS( XARR): 
     XARR.time.attrs['long_name'] = 'time'
     XARR.time.attrs['standard_name'] = 'time'
@@ -406,255 +1071,633 @@ def ADD_TIME_ATTRS( XARR):
     XARR.time.attrs['bounds'] = 'time_bnds'
     return XARR
 
-def ASSIGN_TIME_BOUNDS(XARR):    
+def TIME_BOUNDS(TIMES, PREVIOUS=None, NEXT=None, AVERAGING=None, LABEL='end'):
+    """
+    Time bounds in datetime64, vectorised:
+    without AVERAGING the bounds are the midpoints between neighbouring time steps
+    (irregular steps allowed), the outer bounds are half a step before the first and
+    after the last time step. PREVIOUS/NEXT = last time of the preceding and first
+    time of the following file or slab, so that consecutive parts share their bounds.
+    With AVERAGING (e.g. '10min') the bounds are the averaging interval ending at
+    (LABEL='end'), starting at ('start') or centred on ('center') each time stamp.
+    OUTPUT: bounds = array (time, 2) of datetime64[ns]
+    """
+    times = np.asarray(TIMES, dtype='datetime64[ns]')
+    if AVERAGING is not None:
+        interval = np.timedelta64(pd.Timedelta(AVERAGING).value, 'ns')
+        offsets  = {'end' : (-interval, 0 * interval), 'start' : (0 * interval, interval),
+                    'center' : (-interval // 2, interval - interval // 2)}[LABEL]
+        return np.stack([times + offsets[0], times + offsets[1]], axis=1)
+
+    parts = [times]
+    if PREVIOUS is not None:
+        parts.insert(0, np.asarray([PREVIOUS], dtype='datetime64[ns]'))
+    if NEXT is not None:
+        parts.append(np.asarray([NEXT], dtype='datetime64[ns]'))
+    full = np.concatenate(parts)
+    if full.size < 2:
+        print('WARNING: TIME_BOUNDS: single time step without averaging interval, bounds have no width')
+        return np.stack([times, times], axis=1)
+
+    steps = np.diff(full)
+    if np.any(steps <= np.timedelta64(0, 'ns')):
+        print('WARNING: TIME_BOUNDS: time is not strictly increasing')
+    middle = full[:-1] + steps // 2
+    lower  = np.concatenate([[full[0] - steps[0] // 2], middle])
+    upper  = np.concatenate([middle, [full[-1] + steps[-1] // 2]])
+
+    first = 1 if PREVIOUS is not None else 0
+    last  = full.size - (1 if NEXT is not None else 0)
+    return np.stack([lower[first:last], upper[first:last]], axis=1)
+
+
+@INSTRUMENT
+def ASSIGN_TIME_BOUNDS(XARR, PREVIOUS=None, NEXT=None, AVERAGING=None, LABEL='end'):    
     """
-    TODO: Add time bounds
     process 'time' and 'time bounds'
-    we get the number of time steps and the averaged length of a time step,
-    finally, we create a `time_bnds` (time bounds) variable and fill it with values
+    create a `time_bnds` (time bounds) variable from the time steps (see TIME_BOUNDS)
+    INPUT: PREVIOUS, NEXT = neighbouring time steps of the preceding/following file (None: not known)
+           AVERAGING      = averaging interval of the output (e.g. '10min'), None: midpoints
+           LABEL          = time stamp at the 'end', 'start' or 'center' of the averaging interval
     """
-    
-    nv = 2
-    val_time = XARR.time.values
-
-    # dTime intervale
-    ntime = XARR.time.size
-    dtime = np.mean(val_time[1:(ntime)] - val_time[0:(ntime-1)])
-
-    # calculate bounds
-    array = np.empty((ncid.time.size, nv), 'f8')
-    array[0:ntime,0] = val_time[0:ntime]-dtime/2.0
-    array[0:ntime,1] = val_time[0:ntime]+dtime/2.0
+    bounds = TIME_BOUNDS(XARR.time.values, PREVIOUS, NEXT, AVERAGING, LABEL)
 
     # set time bounds
-    XARR['time_bnds'] = (['time', 'nv'], array)
-    XARR['time_bnds'] = XARR.time_bnds.astype('datetime64[ns]')
+    XARR['time_bnds'] = (['time', 'nv'], bounds)
     XARR['time_bnds'].encoding = {'_FillValue': None}   
     print('INFO: ASSIGN_TIME_BOUNDS done')
 
-    # return XARR
+    return XARR
+
+
+def TIME_NEIGHBOURS(PATH, FILES):
+    """
+    Neighbouring time steps of consecutive files of one model run:
+    files are ordered by their first time step, each file gets the last time of the
+    preceding and the first time of the following file. Only the time axes are read.
+    OUTPUT: dictionary {file: (previous time, next time)}
+    """
+    ranges = {}
+    for infile in FILES:
+        with xr.open_dataset(PATH + infile) as header:
+            if 'time' in header.variables and header.time.size > 0:
+                ranges[infile] = (header.time.values[0], header.time.values[-1])
+    order = sorted(ranges, key=lambda infile: ranges[infile][0])
+    neighbours = {}
+    for n, infile in enumerate(order):
+        previous  = ranges[order[n-1]][1] if n > 0 else None
+        following = ranges[order[n+1]][0] if n < len(order) - 1 else None
+        neighbours[infile] = (previous, following)
+    return neighbours
+
+
+#=============================================================
+#   Temporal aggregation (hourly/daily mean, minimum, maximum, percentiles)
+#=============================================================
+# reductions along time and their cell_methods (CF), 'p<N>' = N-th percentile
+aggregation_methods = {'mean' : 'mean', 'min' : 'minimum', 'max' : 'maximum', 'median' : 'median'}
+
+def AGGREGATION_NAMES(AGGREGATION):
+    """
+    Names of the aggregated products of SETTINGS['aggregation'], e.g. ['1h_mean', '1h_p95'].
+    """
+    if not AGGREGATION:
+        return []
+    return ['{}_{}'.format(window, method) for window in AGGREGATION['windows'] for method in AGGREGATION['methods']]
+
+
+def CF_INTERVAL(SECONDS):
+    """
+    Interval of cell_methods and frequency, e.g. '10 minutes', '1 hour'.
+    """
+    for unit, size in [('day', 86400), ('hour', 3600), ('minute', 60)]:
+        if SECONDS >= size and SECONDS % size == 0:
+            number = int(SECONDS // size)
+            return '{} {}{}'.format(number, unit, 's' if number != 1 else '')
+    return '{:g} seconds'.format(SECONDS)
+
+
+def AGGREGATED_CELL_METHODS(CELLM, METHOD, SAMPLING):
+    """
+    cell_methods of a variable reduced along time (METHOD: mean, min, max, median, p<N>).
+    'time: point' of instantaneous values is replaced, other time methods are
+    kept and the reduction is appended (applied in the listed order, CF).
+    SAMPLING = interval of the input time steps in seconds (None: unknown)
+    """
+    import re
+
+    if METHOD in aggregation_methods:
+        entry = 'time: ' + aggregation_methods[METHOD]
+        comment = ''
+    else:
+        entry = 'time: percentile'
+        comment = ' comment: {}th percentile'.format(METHOD[1:])
+    if SAMPLING:
+        entry += ' (interval: {}{})'.format(CF_INTERVAL(SAMPLING), comment)
+    elif comment:
+        entry += ' ({})'.format(comment.strip())
+
+    point = re.compile(r'time:\s*point(\s*\([^)]*\))?')
+    if not CELLM:
+        return entry
+    if point.search(CELLM):
+        return point.sub(entry, CELLM, count=1)
+    return CELLM + ' ' + entry
+
+
+def TIME_WINDOWS(TIMES, WINDOW):
+    """
+    Split the time steps into windows of fixed length (e.g. '1h', '1D', aligned to the clock).
+    A time step belongs to the window of TIMES (for the aggregation see AGGREGATION_TIMES).
+    OUTPUT: list of slices of consecutive time steps
+    """
+    starts = pd.DatetimeIndex(TIMES).floor(WINDOW).values
+    change = np.flatnonzero(starts[1:] != starts[:-1]) + 1
+    edges  = np.concatenate([[0], change, [starts.size]])
+    return [slice(int(first), int(last)) for first, last in zip(edges[:-1], edges[1:])]
+
+
+def AGGREGATION_TIMES(TIMES, BOUNDS):
+    """
+    Time which decides the window of each time step in the aggregation:
+    instantaneous values (time inside its bounds, e.g. midpoint bounds) by their
+    time stamp, values averaged over an interval which ends or starts at the time
+    stamp by the centre of the interval: 11:00 averaged over 10:50-11:00 belongs to 10:00-11:00.
+    """
+    times  = np.asarray(TIMES, dtype='datetime64[ns]')
+    centre = BOUNDS[:, 0] + (BOUNDS[:, 1] - BOUNDS[:, 0]) // 2
+    inside = (BOUNDS[:, 0] < times) & (times < BOUNDS[:, 1])
+    return np.where(inside, times, centre)
+
+
+@INSTRUMENT
+def AGGREGATE_TIME(XARR, WINDOW, METHOD, LABEL='end', SAMPLING=None):
+    """
+    Reduce the variables with time dimension over time windows (TIME_WINDOWS, AGGREGATION_TIMES).
+    The reductions stay lazy (dask), one window of one chunk is held in memory:
+    written together with the full output, every input chunk is read once.
+    Only complete windows are written: windows with fewer time steps than WINDOW
+    divided by the time step (e.g. at the start and end of a file) are dropped.
+    time_bnds are the windows on the clock, time is their 'end', 'start' or 'center'.
+    INPUT: WINDOW   = length of the windows, e.g. '1h', '1D'
+           METHOD   = 'mean', 'min', 'max', 'median' or 'p<N>' (N-th percentile, e.g. 'p95')
+           SAMPLING = interval of the input time steps in seconds (cell_methods)
+    OUTPUT: XARR = dataset with one time step per window, static variables unchanged
+                   (None if there is no complete window)
+    """
+    if METHOD not in aggregation_methods and not (METHOD[:1] == 'p' and METHOD[1:].replace('.', '', 1).isdigit()):
+        print('ERROR: AGGREGATE_TIME: unknown method {}, choose from {} or p<N>. Stopping program.'.format(
+              METHOD, list(aggregation_methods)))
+        raise SystemExit(1)
+
+    bounds   = np.asarray(XARR.time_bnds.values, dtype='datetime64[ns]')
+    times    = AGGREGATION_TIMES(XARR.time.values, bounds)
+    timevars = [var for var in XARR.data_vars if 'time' in XARR[var].dims and var != 'time_bnds']
+
+    # complete windows: as many time steps as fit into the window
+    length = np.timedelta64(pd.Timedelta(WINDOW).value, 'ns')
+    if times.size > 1:
+        step = np.median(np.diff(times).astype('i8'))
+    else:
+        step = float((bounds[0, 1] - bounds[0, 0]).astype('i8'))
+    expected = max(1, int(round(length.astype('i8') / step))) if step > 0 else 1
+    windows  = TIME_WINDOWS(times, WINDOW)
+    dropped  = len(windows)
+    windows  = [window for window in windows if window.stop - window.start >= expected]
+    dropped -= len(windows)
+    if dropped:
+        print('INFO: AGGREGATE_TIME: {} incomplete windows of {} dropped (less than {} time steps)'.format(
+              dropped, WINDOW, expected))
+    if not windows:
+        print('INFO: AGGREGATE_TIME: no complete window of {}, no {} product'.format(WINDOW, METHOD))
+        return None
+
+    parts = []
+    for window in windows:
+        part = XARR[timevars].isel(time=window)
+        if METHOD in aggregation_methods:
+            parts.append(getattr(part, METHOD)('time', keep_attrs=True))
+        else:
+            # percentiles need all time steps of the window in one chunk
+            part = part.chunk({'time' : -1})
+            parts.append(part.quantile(float(METHOD[1:]) / 100., dim='time', keep_attrs=True).drop_vars('quantile'))
+    reduced = xr.concat(parts, dim='time')
+
+    lower  = pd.DatetimeIndex([times[window.start] for window in windows]).floor(WINDOW).values
+    upper  = lower + length
+    labels = {'end' : upper, 'start' : lower, 'center' : lower + (upper - lower) // 2}
+    reduced['time'] = ('time', labels[LABEL], XARR.time.attrs)
+    reduced['time'].encoding = {key : value for key, value in XARR.time.encoding.items() if key in ['units', 'calendar']}
+
+    XARR_AGG = xr.merge([XARR.drop_dims('time'), reduced], combine_attrs='override')
+    XARR_AGG['time_bnds'] = (['time', 'nv'], np.stack([lower, upper], axis=1))
+    XARR_AGG['time_bnds'].encoding = {'_FillValue': None}
+    for var in timevars:
+        XARR_AGG[var].attrs = dict(XARR[var].attrs)
+        XARR_AGG[var].attrs['cell_methods'] = AGGREGATED_CELL_METHODS(XARR[var].attrs.get('cell_methods'),
+                                                                     METHOD, SAMPLING)
+        XARR_AGG[var].encoding = {}
+
+    # global attributes of the product
+    XARR_AGG.attrs = dict(XARR.attrs)
+    XARR_AGG.attrs['frequency'] = '{:d}s'.format(int(pd.Timedelta(WINDOW).total_seconds()))
+    # marker of the aggregated products (kept by UPDATE_METADATA)
+    XARR_AGG.attrs['aggregation'] = '{} {}'.format(WINDOW, METHOD)
+    XARR_AGG.attrs['history'] = XARR.attrs.get('history', '') + '\n{}: time: {} over {} windows with nc2atmodat.py'.format(
+                                datetime.now().strftime('%a %b %d %Y'), METHOD, WINDOW)
+    print('INFO: AGGREGATE_TIME: {} time steps -> {} windows of {} ({})'.format(XARR.sizes['time'], len(windows), WINDOW, METHOD))
+    return XARR_AGG
+
+
+def AGGREGATE_OUTPUTS(OUTPUTS, AGGREGATION, SAMPLING=None):
+    """
+    Aggregated products of the output datasets (AGGREGATE_TIME), for each window and method.
+    INPUT: OUTPUTS     = {outfile : dataset}, outfile = nc2atmodat_<...>
+           AGGREGATION = {'windows' : ['1h', ...], 'methods' : ['mean', 'max', 'p95', ...], 'label' : 'end'}
+    OUTPUT: {nc2atmodat_<window>_<method>_<...> : dataset}
+    """
+    products = {}
+    for outfile, XARR in OUTPUTS.items():
+        if 'time' not in XARR.dims or 'time_bnds' not in XARR.variables:
+            print('INFO: AGGREGATE_OUTPUTS: {} has no time bounds, not aggregated'.format(outfile))
+            continue
+        for name in AGGREGATION_NAMES(AGGREGATION):
+            window, method = name.split('_', 1)
+            product = AGGREGATE_TIME(XARR, window, method, AGGREGATION.get('label', 'end'), SAMPLING)
+            if product is not None:
+                products[outfile.replace('nc2atmodat_', 'nc2atmodat_' + name + '_', 1)] = product
+    return products
+
+
+def SAMPLING_INTERVAL(XARR, AVERAGING=None):
+    """
+    Interval of the input time steps in seconds: averaging interval of the output
+    (time_averaging) or the median step (None for a single time step).
+    """
+    if AVERAGING is not None:
+        return pd.Timedelta(AVERAGING).total_seconds()
+    if 'time' not in XARR.dims or XARR.sizes['time'] < 2:
+        return None
+    steps = np.diff(np.asarray(XARR.time.values, dtype='datetime64[ns]'))
+    return float(np.median(steps.astype('i8'))) / 1e9
+
+#============================================================= 
+#   Projection service: cached projections, transformers and lat/lon grids
+#=============================================================
+projection_cache = {}
+transformer_cache = {}
+geocoordinates_cache = {}
+
+@INSTRUMENT
+def GET_PROJECTION(PARAMS):
+    """
+    Projection (pyproj.Proj) for the parameters PARAMS, created once per process.
+    PARAMS = dictionary, e.g. {'proj': 'utm', 'zone': 32, 'ellps': 'WGS84', 'preserve_units': False}
+    """
+    key = repr(sorted(PARAMS.items()))
+    if key not in projection_cache:
+        projection_cache[key] = Proj(**PARAMS)
+    return projection_cache[key]
+
+
+def GET_TRANSFORMER(CRS_WKT):
+    """
+    Transformer from the projected coordinates (CRS as WKT string) to geographical
+    coordinates (lon, lat). Transformers are created once per thread and CRS,
+    pyproj objects must not be shared between threads.
+    """
+    from pyproj import Transformer
+
+    transformers = transformer_cache.setdefault(threading.get_ident(), {})
+    if CRS_WKT not in transformers:
+        crs = CRS.from_wkt(CRS_WKT)
+        transformers[CRS_WKT] = Transformer.from_crs(crs, crs.geodetic_crs, always_xy=True)
+    return transformers[CRS_WKT]
+
+
+def PROJECT_BLOCK(X_UTM, Y_UTM, CRS_WKT):
+    """
+    Inverse projection of one block (dask chunk), see INVERSE_PROJECTION.
+    OUTPUT: array (2, ...) with lon, lat
+    """
+    lon, lat = GET_TRANSFORMER(CRS_WKT).transform(X_UTM, Y_UTM)
+    return np.stack([lon, lat])
+
+
+def GEOCOORDINATES_KEY(FINGERPRINT, NAMES, XREF, YREF, PROJECTION):
+    """
+    Key of a lat/lon grid: fingerprint of the model grid (GRID_FINGERPRINT, includes
+    the x, y grids), names of the grid variables, reference point and CRS.
+    Nothing is computed, the cache is consulted before the projection.
+    """
+    import hashlib
+
+    sha = hashlib.sha1()
+    sha.update(FINGERPRINT.encode())
+    sha.update(repr(tuple(NAMES)).encode())
+    sha.update(repr((float(XREF), float(YREF))).encode())
+    sha.update(PROJECTION.crs.to_wkt().encode())
+    return sha.hexdigest()
+
+
+def INVERSE_PROJECTION(X_UTM, Y_UTM, PROJECTION, KEY=None, CACHE_DIR=None, BLOCKSIZE=512):
+    """
+    lon, lat of the projected coordinates X_UTM, Y_UTM.
+    The projection runs block-wise over dask chunks (BLOCKSIZE rows for numpy input)
+    in the dask thread pool.
+    Without KEY the result stays lazy and is computed while the output is written.
+    With KEY results are memoised (see GEOCOORDINATES_KEY) in memory and,
+    if CACHE_DIR is set, as .npz file on disk for later runs.
+    """
+    import dask.array as da
+
+    if KEY is not None and KEY in geocoordinates_cache:
+        print('INFO: INVERSE_PROJECTION: lon, lat taken from cache')
+        return geocoordinates_cache[KEY]
+
+    cachefile = None
+    if KEY is not None and CACHE_DIR:
+        cachefile = os.path.join(CACHE_DIR, 'geocoordinates_{}.npz'.format(KEY))
+        if os.path.exists(cachefile):
+            with np.load(cachefile) as cached:
+                lon, lat = cached['lon'], cached['lat']
+            geocoordinates_cache[KEY] = (lon, lat)
+            print('INFO: INVERSE_PROJECTION: lon, lat taken from cache')
+            return lon, lat
+
+    if not isinstance(X_UTM, da.Array):
+        X_UTM = da.from_array(np.asarray(X_UTM), chunks=(BLOCKSIZE,) + np.shape(X_UTM)[1:])
+    Y_UTM = da.asarray(Y_UTM).rechunk(X_UTM.chunks)
+    lonlat = da.map_blocks(PROJECT_BLOCK, X_UTM, Y_UTM, PROJECTION.crs.to_wkt(),
+                           new_axis=0, chunks=((2,),) + X_UTM.chunks, dtype='f8')
+    lon, lat = lonlat[0], lonlat[1]
+    if KEY is None:
+        return lon, lat
+
+    # cache: compute now (in parallel)
+    lon, lat = da.compute(lon, lat)
+    if KEY is not None:
+        geocoordinates_cache[KEY] = (lon, lat)
+    if cachefile:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # write to a temporary file first, parallel workers may write the same key
+            tmpfile = cachefile + '.{}.tmp.npz'.format(os.getpid())
+            np.savez(tmpfile, lon=lon, lat=lat)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            print('INFO: INVERSE_PROJECTION: cache directory {} not writable'.format(CACHE_DIR))
+    return lon, lat
+
 
 #============================================================= 
     
-def GEOCOORDINATES(XARR, PROJECTION, SWITCH, XREF, YREF):
+@INSTRUMENT
+def GEOCOORDINATES(XARR, PROJECTION, SWITCH, XREF, YREF, CACHE_DIR=None, USE_CACHE=True, PROFILE=None):
     """
     Reassigning coordinates.
     old lat, lon are used to calculate UTM and geographical lat, lon coordinates
     Reference Point can be set manually otherwise using model reference point.
     Default reference Point: UTM GEOMATIKUM
+    lat, lon are cached (see INVERSE_PROJECTION), CACHE_DIR = directory of the disk cache,
+    USE_CACHE = False: lat, lon are computed block-wise while writing the output (lazy)
+    PROFILE = grid profile of the dataset (see GRID_PROFILE), its fingerprint is the cache key
     using xarray module
     """
+    #--- Cartesian Coordinates (in meters)
+    #--- variables lat, lon (MITRAS) are handles as x,y .
+    #--- rewuired: lat(j,i), lon(j,i) 
     try:
-        #--- Cartesian Coordinates (in meters)
-        #--- variables lat, lon (MITRAS) are handles as x,y .
-        #--- rewuired: lat(j,i), lon(j,i) 
-        x_val = XARR.lon.values
-        y_val = XARR.lat.values
-    
-        # Reference Point:
-        #------------------------------
-        if SWITCH == True:
-            # method 1: use own coordinates XREF & YREF (assigned by User)
-            pass
-        else:
-            # method 2: using reference point in data (assigned in GA-File)
-            try: 
-                # Format: dd.dddd
-                elam = XARR.elam  # lon
-                ephi = XARR.ephi  # lat
-                # convert elam & ephi to utm
-                XREF, YREF = PROJECTION(elam, ephi, inverse=False)
-            except:
-                XREF, YREF = 564568.279, 5935921.365
-                print('INFO: GEOCOORDINATES: no reference point in dataset, using default coordinates (Geomatikum)')
-                   
-        # Calculate UTM coordinates
-        #------------------------------
-        # Recreate UTM Coordinates
-        # XREF,YREF = Referencepoint in UTM, and x_val, y_val in meters
-        x_utm = XREF + x_val
-        y_utm = YREF + y_val
-    
-        # Add x_utm, y_utm to netCDF and add attributes to coordinates
-        XARR['x_utm'] = (['j','i'], x_utm)
-        XARR['y_utm'] = (['j','i'], y_utm)
-    
-        XARR.x_utm.attrs = {'long_name'     : 'easting',
-                            'standard_name' : 'projection_x_coordinate',
-                            'units'         : 'm'}
-        XARR.y_utm.attrs = {'long_name'     : 'northing',
-                            'standard_name' : 'projection_y_coordinate',
-                            'units'         : 'm'}
-        
-        # Calculate lat lon coordinates
-        #------------------------------
-        # create data array for lat, lon from x_utm, y_utm
-        x_dummy = XARR.x_utm.copy()
-        y_dummy = XARR.y_utm.copy()
-    
-        # recalculate lat lon based on utm with the projection function:
-        lon, lat = PROJECTION(x_dummy, y_dummy, inverse=True)
-    
-        # assign variables to netCDF and add attributes to coordinates
-        XARR['lon'] = (('j','i'), lon)
-        XARR['lat'] = (('j','i'), lat)
-    
-        XARR.lon.attrs = {'long_name'     : 'longitude',
-                          'standard_name' : 'longitude',
-                          'units'         : 'degrees_east'}
-        XARR.lat.attrs = {'long_name'     : 'latitude',
-                          'standard_name' : 'latitude',
-                          'units'         : 'degrees_north'}
+        x_val = XARR['lon'].data
+        y_val = XARR['lat'].data
+    except KeyError:
+        print('INFO: GEOCOORDINATES was not executed: lon, lat variables are missing.') 
+        return XARR
+
+    # Reference Point:
+    #------------------------------
+    if SWITCH == True:
+        # method 1: use own coordinates XREF & YREF (assigned by User)
+        pass
+    else:
+        # method 2: using reference point in data (assigned in GA-File)
+        try: 
+            # Format: dd.dddd
+            elam = XARR.elam  # lon
+            ephi = XARR.ephi  # lat
+            # convert elam & ephi to utm
+            XREF, YREF = PROJECTION(elam, ephi, inverse=False)
+        except:
+            XREF, YREF = 564568.279, 5935921.365
+            print('INFO: GEOCOORDINATES: no reference point in dataset, using default coordinates (Geomatikum)')
+               
+    # Calculate UTM coordinates
+    #------------------------------
+    # Recreate UTM Coordinates
+    # XREF,YREF = Referencepoint in UTM, and x_val, y_val in meters
+    x_utm = XREF + x_val
+    y_utm = YREF + y_val
+
+    # Add x_utm, y_utm to netCDF and add attributes to coordinates
+    XARR['x_utm'] = (['j','i'], x_utm)
+    XARR['y_utm'] = (['j','i'], y_utm)
+
+    XARR.x_utm.attrs = {'long_name'     : 'easting',
+                        'standard_name' : 'projection_x_coordinate',
+                        'units'         : 'm'}
+    XARR.y_utm.attrs = {'long_name'     : 'northing',
+                        'standard_name' : 'projection_y_coordinate',
+                        'units'         : 'm'}
     
-        print('INFO: GEOCOORDINATES: adding UTM and geographical coordinates to ncfile') 
+    # Calculate lat lon coordinates
+    #------------------------------
+    # recalculate lat lon based on utm with the projection function:
+    key = None
+    if USE_CACHE:
+        fingerprint = PROFILE['fingerprint'] if PROFILE else GRID_FINGERPRINT(XARR)
+        key = GEOCOORDINATES_KEY(fingerprint, ['lon', 'lat'], XREF, YREF, PROJECTION)
+    lon, lat = INVERSE_PROJECTION(x_utm, y_utm, PROJECTION, key, CACHE_DIR)
+
+    # assign variables to netCDF and add attributes to coordinates
+    XARR['lon'] = (('j','i'), lon)
+    XARR['lat'] = (('j','i'), lat)
+
+    XARR.lon.attrs = {'long_name'     : 'longitude',
+                      'standard_name' : 'longitude',
+                      'units'         : 'degrees_east'}
+    XARR.lat.attrs = {'long_name'     : 'latitude',
+                      'standard_name' : 'latitude',
+                      'units'         : 'degrees_north'}
+
+    print('INFO: GEOCOORDINATES: adding UTM and geographical coordinates to ncfile') 
 
-    except:
-        print('INFO: GEOCOORDINATES was not executed: lon, lat variables are missing.') 
-        
     return XARR
 
 
 #============================================================= 
     
-def GEOCOORDINATES_VECTOR(XARR, PROJECTION, SWITCH, XREF, YREF):
+@INSTRUMENT
+def GEOCOORDINATES_VECTOR(XARR, PROJECTION, SWITCH, XREF, YREF, CACHE_DIR=None, USE_CACHE=True, PROFILE=None):
     """
     Reassigning coordinates.
     old latv, latu, lonv, lonu are used to calculate UTM and geographical coordinates.
     Reference Point can be set manually otherwise using model reference point.
     Default reference Point: UTM GEOMATIKUM
+    lat, lon are cached (see INVERSE_PROJECTION), CACHE_DIR = directory of the disk cache,
+    USE_CACHE = False: lat, lon are computed block-wise while writing the output (lazy)
+    PROFILE = grid profile of the dataset (see GRID_PROFILE), its fingerprint is the cache key
     using xarray, pyproj
     """
 
+    # Cartesian Coordinates (in meters)
+    # variables lat, lon (MITRAS) are handles as x,y .
     try:
-    
-        # Cartesian Coordinates (in meters)
-        # variables lat, lon (MITRAS) are handles as x,y .
-        xu_val = XARR.lonu.values
-        xv_val = XARR.lonv.values
-        yu_val = XARR.latu.values
-        yv_val = XARR.latv.values
-    
-        # Reference Point:
-        #------------------------------
-        if SWITCH == True:
-            # method 1: use own coordinates XREF & YREF (assigned by User)
-            pass
-        else:
-            # method 2: using reference point in data (assigned in GA-File)
-            try: 
-                # Format: dd.dddd
-                elam = XARR.elam  # lon
-                ephi = XARR.ephi  # lat
-                # convert elam & ephi to utm
-                XREF, YREF = PROJECTION(elam, ephi, inverse=False)
-            except:
-                XREF, YREF = 564568.279, 5935921.365
-                print('INFO: GEOCOORDINATES_VECTOR no reference point in dataset, using default coordinates (Geomatikum)')
-                   
-        # Calculate UTM coordinates
-        #------------------------------
-        # Recreate UTM Coordinates
-        # XREF,YREF = Referencepoint in UTM, and x_val, y_val in meters
-        xu_utm = XREF + xu_val
-        xv_utm = XREF + xv_val
-        yu_utm = YREF + yu_val
-        yv_utm = YREF + yv_val
-    
-        # Add x_utm, y_utm to netCDF and add attributes to coordinates
-        XARR['xu_utm'] = (['j','iv'], xu_utm)
-        XARR['xv_utm'] = (['jv','i'], xv_utm)
-        XARR['yu_utm'] = (['j','iv'], yu_utm)
-        XARR['yv_utm'] = (['jv','i'], yv_utm)
-    
-        XARR.xu_utm.attrs = {'long_name' : 'xu-easting',
-                            'units'      : 'm'}
-        XARR.xv_utm.attrs = {'long_name' : 'xv-northing',
-                            'units'      : 'm'}
-        XARR.yu_utm.attrs = {'long_name' : 'yu-easting',
-                            'units'      : 'm'}
-        XARR.yv_utm.attrs = {'long_name' : 'yv-northing',
-                            'units'      : 'm'}
-        
-        # Calculate lat lon coordinates
-        #------------------------------
-        # create data array for lat, lon from x_utm, y_utm
-        xu_dummy = XARR.xu_utm.copy()
-        xv_dummy = XARR.xv_utm.copy()
-        yu_dummy = XARR.yu_utm.copy()
-        yv_dummy = XARR.yv_utm.copy()
-    
-        # recalculate lat lon based on utm with the projection function:
-        lonu, latu = PROJECTION(xu_dummy, yu_dummy, inverse=True)
-        lonv, latv = PROJECTION(xv_dummy, yv_dummy, inverse=True)
-    
-        # assign variables to netCDF and add attributes to coordinates
-        XARR['lonu'] = (('j','iv'), lonu)
-        XARR['latu'] = (('j','iv'), latu)
-        XARR['lonv'] = (('jv','i'), lonv)
-        XARR['latv'] = (('jv','i'), latv)
-    
-        XARR.lonu.attrs = {'long_name' : 'u-longitude',
-                          'units'      : 'degrees_east'}
-        XARR.latu.attrs = {'long_name' : 'u-latitude',
-                          'units'      : 'degrees_north'}    
-        XARR.lonv.attrs = {'long_name' : 'v-longitude',
-                          'units'      : 'degrees_east'}
-        XARR.latv.attrs = {'long_name' : 'v-latitude',
-                          'units'      : 'degrees_north'}
-    
-        print('INFO:GEOCOORDINATES_VECTOR adding vector UTM and geographical coordinates to ncfile') 
-    except:
+        xu_val = XARR['lonu'].data
+        xv_val = XARR['lonv'].data
+        yu_val = XARR['latu'].data
+        yv_val = XARR['latv'].data
+    except KeyError:
         print('INFO: GEOCOORDINATES_VECTOR was not executed: variables are missing.') 
-        
+        return XARR
+
+    # Reference Point:
+    #------------------------------
+    if SWITCH == True:
+        # method 1: use own coordinates XREF & YREF (assigned by User)
+        pass
+    else:
+        # method 2: using reference point in data (assigned in GA-File)
+        try: 
+            # Format: dd.dddd
+            elam = XARR.elam  # lon
+            ephi = XARR.ephi  # lat
+            # convert elam & ephi to utm
+            XREF, YREF = PROJECTION(elam, ephi, inverse=False)
+        except:
+            XREF, YREF = 564568.279, 5935921.365
+            print('INFO: GEOCOORDINATES_VECTOR no reference point in dataset, using default coordinates (Geomatikum)')
+               
+    # Calculate UTM coordinates
+    #------------------------------
+    # Recreate UTM Coordinates
+    # XREF,YREF = Referencepoint in UTM, and x_val, y_val in meters
+    xu_utm = XREF + xu_val
+    xv_utm = XREF + xv_val
+    yu_utm = YREF + yu_val
+    yv_utm = YREF + yv_val
+
+    # Add x_utm, y_utm to netCDF and add attributes to coordinates
+    XARR['xu_utm'] = (['j','iv'], xu_utm)
+    XARR['xv_utm'] = (['jv','i'], xv_utm)
+    XARR['yu_utm'] = (['j','iv'], yu_utm)
+    XARR['yv_utm'] = (['jv','i'], yv_utm)
+
+    XARR.xu_utm.attrs = {'long_name' : 'xu-easting',
+                        'units'      : 'm'}
+    XARR.xv_utm.attrs = {'long_name' : 'xv-northing',
+                        'units'      : 'm'}
+    XARR.yu_utm.attrs = {'long_name' : 'yu-easting',
+                        'units'      : 'm'}
+    XARR.yv_utm.attrs = {'long_name' : 'yv-northing',
+                        'units'      : 'm'}
+    
+    # Calculate lat lon coordinates
+    #------------------------------
+    # recalculate lat lon based on utm with the projection function:
+    key_u, key_v = None, None
+    if USE_CACHE:
+        fingerprint = PROFILE['fingerprint'] if PROFILE else GRID_FINGERPRINT(XARR)
+        key_u = GEOCOORDINATES_KEY(fingerprint, ['lonu', 'latu'], XREF, YREF, PROJECTION)
+        key_v = GEOCOORDINATES_KEY(fingerprint, ['lonv', 'latv'], XREF, YREF, PROJECTION)
+    lonu, latu = INVERSE_PROJECTION(xu_utm, yu_utm, PROJECTION, key_u, CACHE_DIR)
+    lonv, latv = INVERSE_PROJECTION(xv_utm, yv_utm, PROJECTION, key_v, CACHE_DIR)
+
+    # assign variables to netCDF and add attributes to coordinates
+    XARR['lonu'] = (('j','iv'), lonu)
+    XARR['latu'] = (('j','iv'), latu)
+    XARR['lonv'] = (('jv','i'), lonv)
+    XARR['latv'] = (('jv','i'), latv)
+
+    XARR.lonu.attrs = {'long_name' : 'u-longitude',
+                      'units'      : 'degrees_east'}
+    XARR.latu.attrs = {'long_name' : 'u-latitude',
+                      'units'      : 'degrees_north'}    
+    XARR.lonv.attrs = {'long_name' : 'v-longitude',
+                      'units'      : 'degrees_east'}
+    XARR.latv.attrs = {'long_name' : 'v-latitude',
+                      'units'      : 'degrees_north'}
+
+    print('INFO:GEOCOORDINATES_VECTOR adding vector UTM and geographical coordinates to ncfile') 
     
     return XARR
 
 
 #=============================================================
+@INSTRUMENT
 def SELECT_OUTPUT_VARIABLES(XARR, OWN_VAR_LIST):
     """
-    Prepare output, select variables
+    Prepare output, select variables (see VARIABLE_REGISTRY):
+    variable_list, coordinate_list, variable_patterns and custom_variables,
+    without variable_exclusions. The rule selecting each variable is reported.
     using xarray module
     """
-    
-    # get variables from file 
-    varlist = list(XARR)    
-    output =[]            
+    registry = VARIABLE_REGISTRY(OWN_VAR_LIST)
 
-    # get variable_list and check against netcdf variables
-    from dict_OUTPUT_variables import variable_list
-    
-    for var in varlist:
-        if var in variable_list.values():
+    output = []
+    for var in XARR.data_vars:
+        selected, rule = SELECT_VARIABLE(registry, var)
+        if selected:
             output.append(var)
-        else:
-            pass
-
-    #add custom variables:
-    if OWN_VAR_LIST:  # check if list is not empty
-        for var in OWN_VAR_LIST: 
-            if not var in output: # check if var is not in output
-                output.append(var)
-    else: 
-        pass
-
-
-    #--- reduce size of netCDF if possible:
-    try: 
-        if  len(output) != 0:
-            print('INFO: SELECT_OUTPUT_VARIABLES: available output variables:', end=' ')
-            print(*output)
-            return XARR[output]  
-    except:   
-        if len(output) == 0:
-                raise Exception('WARNING: NO VARIABLES ARE PROVIDED. Please provide Output variables via dict_OUTPUT_variables or custom_variables (see USER INPUT SECTION)')
-    finally:
-        print('INFO: SELECT_OUTPUT_VARIABLES: all variables provided!')
-        return XARR
+            print('INFO: SELECT_OUTPUT_VARIABLES: {:20s} selected by {}'.format(var, rule))
+        elif rule is not None:
+            print('INFO: SELECT_OUTPUT_VARIABLES: {:20s} excluded by {}'.format(var, rule))
+
+    for var in OWN_VAR_LIST:
+        pattern = any(char in var for char in '*?[') or var.startswith('re:')
+        if not pattern and var not in XARR.variables:
+            print('WARNING: SELECT_OUTPUT_VARIABLES: custom variable {} not found in file'.format(var))
+
+    if len(output) == 0:
+        raise Exception('WARNING: NO VARIABLES ARE PROVIDED. Please provide Output variables via dict_OUTPUT_variables or custom_variables (see USER INPUT SECTION)')
+    print('INFO: SELECT_OUTPUT_VARIABLES: {} of {} variables selected'.format(len(output), len(XARR.data_vars)))
+    return XARR[output]
         
     
 #=============================================================
-def ADD_GLOBAL_ATTRS(METADATA_TABLE):
+# parsed global attributes, key: (spreadsheet, mtime, size)
+global_attrs_cache = {}
+
+@INSTRUMENT
+def ADD_GLOBAL_ATTRS(METADATA_TABLE, CACHE_DIR=None):
+    """
+    Global attributes from the metadata spreadsheet (see READ_GLOBAL_ATTRS).
+    The parsed attributes are cached in memory and, if CACHE_DIR is set, in a
+    JSON sidecar file. The spreadsheet is parsed again only if it was changed
+    (modification time, size and hash). creation_date is set for each call.
+    """
+    stat = os.stat(METADATA_TABLE)
+    key  = (os.path.abspath(METADATA_TABLE), stat.st_mtime_ns, stat.st_size)
+
+    if key in global_attrs_cache:
+        dictglat = global_attrs_cache[key]
+    else:
+        sidecar = None
+        if CACHE_DIR:
+            sidecar = os.path.join(CACHE_DIR, os.path.basename(METADATA_TABLE) + '.json')
+        dictglat = READ_GLOBAL_ATTRS_SIDECAR(sidecar, METADATA_TABLE, stat)
+        if dictglat is None:
+            dictglat = READ_GLOBAL_ATTRS(METADATA_TABLE)
+            WRITE_GLOBAL_ATTRS_SIDECAR(sidecar, METADATA_TABLE, stat, dictglat)
+        global_attrs_cache[key] = dictglat
+
+    dictglat = dict(dictglat)
+    dictglat['creation_date'] = datetime.now().isoformat(timespec='seconds')
+  
+    print('INFO: ADD_GLOBAL_ATTRS: adding global metadata to ncfile')
+    return dictglat
+
+
+def READ_GLOBAL_ATTRS(METADATA_TABLE):
     """
     Created by Angelika Heil
     Get columns requirements and BSH entry from excel file; 
@@ -670,12 +1713,78 @@ def ADD_GLOBAL_ATTRS(METADATA_TABLE):
     glat = glat.replace(to_replace=r'#', value='', regex=True)
     #history2021 = glat[(glat['Requirements'] == 'history_year2021')].iloc[0,1]  ##-- same as glat['Entry_by_user'].iloc[-1]
     dictglat  = dict(zip(glat.iloc[:-1, 0].str.strip(),glat['Entry_by_user']))   #-- except last row
-    dictglat['creation_date'] = datetime.now().isoformat(timespec='seconds')
-  
-    print('INFO: ADD_GLOBAL_ATTRS: adding global metadata to ncfile')
+
+    # plain python types (numpy scalars, timestamps), required for the JSON sidecar
+    for attr, value in dictglat.items():
+        if isinstance(value, np.generic):
+            dictglat[attr] = value.item()
+        elif isinstance(value, (datetime, pd.Timestamp)):
+            dictglat[attr] = value.isoformat()
+    print('INFO: READ_GLOBAL_ATTRS: metadata spreadsheet parsed')
     return dictglat
 
 
+def FILE_HASH(FILE, BLOCKSIZE=2**20):
+    """
+    sha1 hash of the content of FILE
+    """
+    import hashlib
+
+    sha = hashlib.sha1()
+    with open(FILE, 'rb') as fid:
+        for block in iter(lambda: fid.read(BLOCKSIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def READ_GLOBAL_ATTRS_SIDECAR(SIDECAR, METADATA_TABLE, STAT):
+    """
+    Global attributes from the JSON sidecar, None if the sidecar does not exist
+    or the spreadsheet was changed.
+    """
+    import json
+
+    if not SIDECAR or not os.path.exists(SIDECAR):
+        return None
+    try:
+        with open(SIDECAR) as fid:
+            sidecar = json.load(fid)
+    except (OSError, ValueError):
+        return None
+
+    if sidecar.get('mtime_ns') != STAT.st_mtime_ns or sidecar.get('size') != STAT.st_size:
+        # modification time changed (e.g. copied file): compare the content
+        if sidecar.get('sha1') != FILE_HASH(METADATA_TABLE):
+            return None
+        WRITE_GLOBAL_ATTRS_SIDECAR(SIDECAR, METADATA_TABLE, STAT, sidecar['attrs'], sidecar['sha1'])
+    print('INFO: ADD_GLOBAL_ATTRS: metadata taken from {}'.format(SIDECAR))
+    return sidecar['attrs']
+
+
+def WRITE_GLOBAL_ATTRS_SIDECAR(SIDECAR, METADATA_TABLE, STAT, ATTRS, SHA1=None):
+    """
+    Store the parsed global attributes as JSON sidecar.
+    """
+    import json
+
+    if not SIDECAR:
+        return
+    sidecar = {'source'   : os.path.abspath(METADATA_TABLE),
+               'mtime_ns' : STAT.st_mtime_ns,
+               'size'     : STAT.st_size,
+               'sha1'     : SHA1 or FILE_HASH(METADATA_TABLE),
+               'attrs'    : ATTRS}
+    try:
+        os.makedirs(os.path.dirname(SIDECAR) or '.', exist_ok=True)
+        tmpfile = SIDECAR + '.{}.tmp'.format(os.getpid())
+        with open(tmpfile, 'w') as fid:
+            json.dump(sidecar, fid, indent=1)
+        os.replace(tmpfile, SIDECAR)
+    except OSError:
+        print('INFO: ADD_GLOBAL_ATTRS: sidecar {} not writable'.format(SIDECAR))
+
+
+@INSTRUMENT
 def ADD_GLOBAL_HISTORY_ATTRS(PATHFILE):
     """
     Adding dataset creation date and modification date to global metadata
@@ -688,6 +1797,7 @@ def ADD_GLOBAL_HISTORY_ATTRS(PATHFILE):
     return globattr_hist   
 
 
+@INSTRUMENT
 def DELETE_GLOBAL_ATTRS(XARR):
     """
     Deletes MEMI attribues
@@ -717,6 +1827,7 @@ def DELETE_GLOBAL_ATTRS(XARR):
     return XARR
 
 #=============================================================
+@INSTRUMENT
 def ADD_CUSTOM_ATTRIBUTES_TO_VARIABLES(XARR):
     """
     assign comments and corrections to variables.
@@ -735,6 +1846,7 @@ def ADD_CUSTOM_ATTRIBUTES_TO_VARIABLES(XARR):
     return XARR
 
 #=============================================================
+@INSTRUMENT
 def CELL_METHODS(XARR):
     """
     Correction of cell_methods if i,j,k are renamed to x,y,z
@@ -763,6 +1875,7 @@ def CELL_METHODS(XARR):
     return XARR
 
 
+@INSTRUMENT
 def ADD_CELL_METHODS(XARR):
     """
     Add cell_methods if none are assigned
@@ -789,6 +1902,7 @@ def ADD_CELL_METHODS(XARR):
         
 #=============================================================
 
+@INSTRUMENT
 def CORRECTION_VARIABLE_ATTRIBUTES(XARR):
     """
     Formatting corrections to long/standard_names and removing empty variables.
@@ -884,8 +1998,1171 @@ def GRID_MAPPING(XARR, PROJECTION):
     
     # return XARR
 #=============================================================
-  
 
-    
-    
-    
+
+#=============================================================
+#   Output chunking
+#=============================================================
+# order in which dimensions are reduced if a chunk is too large
+vertical_dims = ['k', 'kv', 'z', 'zv', 'lev']
+
+def PLAN_CHUNKS(XARR, CHUNK_MB=16, MEMORY_MB=None, NTHREADS=None):
+    """
+    Plan dask chunks and netCDF chunksizes for the output variables.
+    Starting from the current dask chunks (or the full size), chunks are halved
+    until every variable fits into CHUNK_MB: first along time, then along the
+    vertical and finally along the larger of the horizontal dimensions.
+    Dask chunks and netCDF chunksizes are identical, every dask chunk is written
+    as complete chunks on disk.
+    INPUT: XARR      = xarray dataset (output)
+           CHUNK_MB  = target size of one chunk in MB
+           MEMORY_MB = memory budget in MB (None: no limit), reduces CHUNK_MB so that
+                       NTHREADS chunks (x4 for temporaries) fit into the budget
+           NTHREADS  = number of dask threads (None: dask num_workers, e.g. set by
+                       INIT_BATCH_WORKER, otherwise number of cpus)
+    OUTPUT: chunks   = dictionary {dimension: chunksize}
+            encoding = dictionary {variable: {'chunksizes': (...)}}
+    """
+    target = CHUNK_MB * 1024**2
+    if MEMORY_MB:
+        import dask
+        nthreads = NTHREADS or dask.config.get('num_workers', None) or os.cpu_count() or 1
+        target = min(target, MEMORY_MB * 1024**2 / (4 * nthreads))
+
+    # start: current dask chunks, otherwise full dimension size
+    chunks = dict(XARR.sizes)
+    for var in XARR.variables:
+        if XARR[var].chunks is not None:
+            for dim, dimchunks in zip(XARR[var].dims, XARR[var].chunks):
+                chunks[dim] = min(chunks[dim], max(dimchunks))
+
+    def reducible(dims):
+        order  = [dim for dim in dims if dim == 'time']
+        order += [dim for dim in dims if dim in vertical_dims]
+        order += sorted([dim for dim in dims if dim not in order and dim != 'nv'],
+                        key=lambda dim: chunks[dim], reverse=True)
+        return [dim for dim in order if chunks[dim] > 1]
+
+    # largest variables first, smaller variables share the dimensions
+    variables = [var for var in XARR.variables if XARR[var].ndim > 0 and XARR[var].dtype.kind in 'biufcmM']
+    for var in sorted(variables, key=lambda var: XARR[var].nbytes, reverse=True):
+        dims = XARR[var].dims
+        itemsize = XARR[var].dtype.itemsize
+        while itemsize * np.prod([chunks[dim] for dim in dims]) > target:
+            candidates = reducible(dims)
+            if not candidates:
+                break
+            dim = candidates[0]
+            chunks[dim] = int(np.ceil(chunks[dim] / 2))
+
+    encoding = {var : {'chunksizes' : tuple(chunks[dim] for dim in XARR[var].dims)} for var in variables}
+    print('INFO: PLAN_CHUNKS: chunks', chunks)
+    return chunks, encoding
+
+
+def APPLY_CHUNKS(XARR, CHUNKS):
+    """
+    Rechunk the dask variables and variables larger than one chunk to CHUNKS.
+    Small variables (e.g. bounds, coordinates) remain in memory.
+    """
+    for var in list(XARR.data_vars) + [coord for coord in XARR.coords if coord not in XARR.dims]:
+        dims = XARR[var].dims
+        if XARR[var].chunks is not None or XARR[var].size > np.prod([CHUNKS[dim] for dim in dims]):
+            XARR[var] = XARR[var].chunk({dim: CHUNKS[dim] for dim in dims})
+    return XARR
+
+
+#=============================================================
+#   Output encoding (see dict_encoding_profiles.py)
+#=============================================================
+def GET_ENCODING_CLASS(XARR, VAR):
+    """
+    Class of a variable for the encoding profiles:
+    bounds, coordinate, met3d, surface2d or default
+    """
+    from dict_OUTPUT_variables import coordinate_list
+
+    dims = XARR[VAR].dims
+    if VAR.endswith('_bnds'):
+        return 'bounds'
+    elif VAR in XARR.coords or VAR in XARR.dims or VAR in coordinate_list.values():
+        return 'coordinate'
+    elif len(dims) >= 3 and any(dim in vertical_dims for dim in dims):
+        return 'met3d'
+    elif len(dims) >= 2:
+        return 'surface2d'
+    return 'default'
+
+
+def SET_ENCODING(XARR, ENCODING={}):
+    """
+    Encoding for netCDF output: compression, dtype and _FillValue from
+    dict_encoding_profiles (class profile or custom_encoding of the variable),
+    chunksizes from ENCODING (see PLAN_CHUNKS) unless set in the profile.
+    Units and calendar of time variables are kept.
+    INPUT: XARR = xarray dataset (output)
+           ENCODING = dictionary {variable: {'chunksizes': (...)}}
+    OUTPUT: encoding = dictionary {variable: encoding} for to_netcdf
+    """
+    from netCDF4 import default_fillvals
+    from dict_encoding_profiles import profiles, custom_encoding
+
+    encoding = {}
+    for var in XARR.variables:
+        if var in custom_encoding:
+            profile = dict(custom_encoding[var])
+        else:
+            profile = dict(profiles[GET_ENCODING_CLASS(XARR, var)])
+
+        enc = {key: value for key, value in XARR[var].encoding.items() if key in ['units', 'calendar', 'dtype']
+               and XARR[var].dtype.kind in 'mM'}
+        enc.update(ENCODING.get(var, {}))
+
+        kind = XARR[var].dtype.kind
+        if kind not in 'biufcmM' or XARR[var].ndim == 0:
+            # strings and scalars: no compression or chunking
+            profile = {key: value for key, value in profile.items() if key == '_FillValue'}
+            enc.pop('chunksizes', None)
+        if 'dtype' in profile and kind != 'f':
+            del profile['dtype']
+        if profile.get('_FillValue') == 'default':
+            dtype = np.dtype(profile.get('dtype', XARR[var].dtype))
+            profile['_FillValue'] = default_fillvals.get(dtype.str[1:], None)
+        if kind in 'mM':
+            # datetime: same units and dtype as time (required for chunked bounds)
+            profile.pop('_FillValue', None)
+            time_enc = XARR['time'].encoding if 'time' in XARR.variables else {}
+            for key in ['units', 'calendar', 'dtype']:
+                if key in time_enc and key not in enc:
+                    enc[key] = time_enc[key]
+            if 'units' in enc and 'dtype' not in enc:
+                enc['dtype'] = 'float64'
+        enc.update(profile)
+        encoding[var] = enc
+    print('INFO: SET_ENCODING: encoding profiles assigned to variables')
+    return encoding
+
+
+def REPORT_ENCODING(XARR, OUTFILE, SECONDS):
+    """
+    Report the compression ratio of each variable and the write throughput.
+    Stored sizes of the variables are read with h5py (optional),
+    without h5py only the size of the file is reported.
+    INPUT: XARR    = xarray dataset which was written
+           OUTFILE = written netCDF file
+           SECONDS = duration of the write
+    OUTPUT: report = dictionary {variable: {'raw_MB', 'stored_MB', 'ratio'}}
+    """
+    MB = 1024.**2
+    raw_total = sum(XARR[var].nbytes for var in XARR.variables)
+    stored_total = os.path.getsize(OUTFILE)
+
+    report = {}
+    try:
+        import h5py
+        with h5py.File(OUTFILE, 'r') as h5:
+            for var in XARR.variables:
+                if var in h5 and isinstance(h5[var], h5py.Dataset):
+                    raw = XARR[var].nbytes
+                    stored = h5[var].id.get_storage_size()
+                    report[var] = {'raw_MB'    : raw / MB,
+                                   'stored_MB' : stored / MB,
+                                   'ratio'     : raw / stored if stored else np.nan}
+    except ImportError:
+        print('INFO: REPORT_ENCODING: h5py not installed, report for the whole file only')
+
+    for var in sorted(report, key=lambda var: report[var]['raw_MB'], reverse=True):
+        print('INFO: REPORT_ENCODING: {:<16s} {:10.2f} MB -> {:10.2f} MB  ratio {:6.2f}'.format(
+              var, report[var]['raw_MB'], report[var]['stored_MB'], report[var]['ratio']))
+    print('INFO: REPORT_ENCODING: file {:.2f} MB -> {:.2f} MB, ratio {:.2f}, {:.1f} MB/s ({:.1f} s)'.format(
+          raw_total / MB, stored_total / MB, raw_total / max(stored_total, 1),
+          raw_total / MB / max(SECONDS, 1e-6), SECONDS))
+    return report
+
+
+@INSTRUMENT
+def WRITE_NETCDF(XARR, OUTFILE, SETTINGS):
+    """
+    Write the output dataset to netCDF:
+    plan chunks (PLAN_CHUNKS), assign the encoding profiles (SET_ENCODING),
+    write with dask and report compression and throughput (REPORT_ENCODING).
+    """
+    # dividing file into chunks ( useful for limited memory)
+    chunks, encoding = PLAN_CHUNKS(XARR, SETTINGS['chunk_MB'], SETTINGS['memory_MB'])
+    rechunked = APPLY_CHUNKS(XARR, chunks)
+    if SETTINGS.get('use_encoding_profiles', True):
+        encoding = SET_ENCODING(rechunked, encoding)
+
+    start = datetime.now()
+    write_job = rechunked.to_netcdf(OUTFILE, compute=False, engine='netcdf4', encoding=encoding)
+    with ProgressBar():
+        print(f" INFO: Writing to {OUTFILE}")
+        write_job.compute()
+    seconds = (datetime.now() - start).total_seconds()
+
+    if SETTINGS.get('encoding_report', True):
+        REPORT_ENCODING(XARR, OUTFILE, seconds)
+    return OUTFILE
+
+
+@INSTRUMENT
+def WRITE_NETCDF_ONE_PASS(OUTPUTS, SETTINGS):
+    """
+    Write several output datasets of the same input (regions, aggregated products) in one dask computation:
+    input chunks and processing steps shared by the datasets are computed once.
+    INPUT: OUTPUTS = {outfile : dataset}
+    """
+    import dask
+
+    jobs = []
+    for outfile, XARR in OUTPUTS.items():
+        chunks, encoding = PLAN_CHUNKS(XARR, SETTINGS['chunk_MB'], SETTINGS['memory_MB'])
+        if SETTINGS.get('use_encoding_profiles', True):
+            encoding = SET_ENCODING(XARR, encoding)
+        rechunked = APPLY_CHUNKS(XARR, chunks)
+        jobs.append(rechunked.to_netcdf(outfile, compute=False, engine='netcdf4',
+                                        encoding={var : enc for var, enc in encoding.items() if var in rechunked.variables}))
+
+    start = datetime.now()
+    with ProgressBar():
+        print(' INFO: WRITE_NETCDF_ONE_PASS: writing {} files in one pass'.format(len(jobs)))
+        dask.compute(*jobs)
+    seconds = (datetime.now() - start).total_seconds()
+
+    if SETTINGS.get('encoding_report', True):
+        for outfile, XARR in OUTPUTS.items():
+            REPORT_ENCODING(XARR, outfile, seconds)
+    return list(OUTPUTS)
+
+
+@INSTRUMENT
+def WRITE_NETCDF_STREAMING(XARR, OUTFILE, SETTINGS):
+    """
+    Write the output dataset slab by slab along the (unlimited) time dimension.
+    The first slab is written with all static variables (grid, bounds,
+    coordinates, attributes), the following slabs only append the variables
+    with time dimension. Only one slab is held in memory.
+    Values are encoded as in the first slab (units, dtype, _FillValue of the file).
+    INPUT: SETTINGS['time_slab'] = number of time steps per slab
+    """
+    import netCDF4
+
+    slab = max(1, int(SETTINGS['time_slab']))
+    ntime = XARR.sizes['time']
+
+    # chunks are planned for one slab, every slab consists of complete chunks
+    chunks, encoding = PLAN_CHUNKS(XARR.isel(time=slice(0, slab)), SETTINGS['chunk_MB'], SETTINGS['memory_MB'])
+    rechunked = APPLY_CHUNKS(XARR, chunks)
+    if SETTINGS.get('use_encoding_profiles', True):
+        encoding = SET_ENCODING(rechunked, encoding)
+
+    start = datetime.now()
+    print(' INFO: WRITE_NETCDF_STREAMING: writing {} time steps in slabs of {} to {}'.format(ntime, slab, OUTFILE))
+    with ProgressBar():
+        rechunked.isel(time=slice(0, slab)).to_netcdf(OUTFILE, engine='netcdf4', encoding=encoding,
+                                                      unlimited_dims=['time'])
+
+    timevars = [var for var in rechunked.variables if 'time' in rechunked[var].dims]
+    with netCDF4.Dataset(OUTFILE, 'a') as ncfile:
+        # values are encoded by xarray, netCDF4 writes them unchanged
+        ncfile.set_auto_maskandscale(False)
+        for first in range(slab, ntime, slab):
+            part = rechunked[timevars].isel(time=slice(first, first + slab)).compute()
+            for var in timevars:
+                variable = part[var].variable
+                variable.encoding = {key : ncfile[var].getncattr(key) for key in ['units', 'calendar', '_FillValue']
+                                     if key in ncfile[var].ncattrs()}
+                variable.encoding['dtype'] = ncfile[var].dtype
+                values = xr.conventions.encode_cf_variable(variable, name=var).values
+                index  = tuple(slice(first, first + values.shape[axis]) if dim == 'time' else slice(None)
+                               for axis, dim in enumerate(variable.dims))
+                ncfile[var][index] = values
+            print(' INFO: WRITE_NETCDF_STREAMING: time steps {} to {} appended'.format(first, first + part.sizes['time'] - 1))
+    seconds = (datetime.now() - start).total_seconds()
+
+    if SETTINGS.get('encoding_report', True):
+        REPORT_ENCODING(rechunked, OUTFILE, seconds)
+    return OUTFILE
+
+
+#=============================================================
+#   Zarr output
+#=============================================================
+def ZARR_ENCODING(ENCODING, ZARR_V3=False):
+    """
+    Translate the netCDF encoding (SET_ENCODING) to zarr (format 2):
+    chunksizes -> chunks, zlib/complevel/shuffle -> Blosc compressor (zlib).
+    ZARR_V3 = True for zarr-python >= 3 (key 'compressors' instead of 'compressor')
+    """
+    from numcodecs import Blosc
+
+    encoding = {}
+    for var, enc in ENCODING.items():
+        enc = dict(enc)
+        zlib      = enc.pop('zlib', False)
+        complevel = enc.pop('complevel', 4)
+        shuffle   = enc.pop('shuffle', False)
+        chunksizes = enc.pop('chunksizes', None)
+        if chunksizes is not None:
+            enc['chunks'] = chunksizes
+        if zlib:
+            compressor = Blosc(cname='zlib', clevel=complevel,
+                               shuffle=Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE)
+            if ZARR_V3:
+                enc['compressors'] = (compressor,)
+            else:
+                enc['compressor'] = compressor
+        encoding[var] = enc
+    return encoding
+
+
+@INSTRUMENT
+def WRITE_ZARR(XARR, OUTSTORE, SETTINGS):
+    """
+    Write the output dataset as zarr store with consolidated metadata.
+    Chunks are planned and encoded as for netCDF (PLAN_CHUNKS, SET_ENCODING),
+    each chunk is an own file, so dask writes all chunks concurrently
+    (no HDF5 lock). Attributes are the same as in the netCDF output.
+    """
+    try:
+        import zarr
+    except ImportError:
+        print('ERROR: WRITE_ZARR: zarr is not installed. Stopping program.')
+        raise SystemExit(1)
+
+    chunks, encoding = PLAN_CHUNKS(XARR, SETTINGS['chunk_MB'], SETTINGS['memory_MB'])
+    rechunked = APPLY_CHUNKS(XARR, chunks)
+    if SETTINGS.get('use_encoding_profiles', True):
+        encoding = SET_ENCODING(rechunked, encoding)
+
+    # zarr-python 3 writes zarr format 3 by default, the encoding is format 2
+    zarr_v3 = int(zarr.__version__.split('.')[0]) >= 3
+    encoding = ZARR_ENCODING(encoding, zarr_v3)
+    kwargs = {'zarr_format' : 2} if zarr_v3 else {}
+
+    start = datetime.now()
+    write_job = rechunked.to_zarr(OUTSTORE, mode='w', consolidated=True, compute=False,
+                                  encoding=encoding, **kwargs)
+    with ProgressBar():
+        print(f" INFO: Writing to {OUTSTORE}")
+        write_job.compute()
+    seconds = (datetime.now() - start).total_seconds()
+
+    if SETTINGS.get('encoding_report', True):
+        MB = 1024.**2
+        raw = sum(rechunked[var].nbytes for var in rechunked.variables)
+        stored = sum(os.path.getsize(os.path.join(root, name))
+                     for root, dirs, names in os.walk(OUTSTORE) for name in names)
+        print('INFO: WRITE_ZARR: {:.2f} MB -> {:.2f} MB, ratio {:.2f}, {:.1f} MB/s ({:.1f} s)'.format(
+              raw / MB, stored / MB, raw / max(stored, 1), raw / MB / max(seconds, 1e-6), seconds))
+    return OUTSTORE
+
+
+@INSTRUMENT
+def ZARR_TO_NETCDF(OUTSTORE, OUTFILE, SETTINGS):
+    """
+    Convert a zarr store (WRITE_ZARR) to netCDF4 for archival.
+    """
+    XARR = xr.open_zarr(OUTSTORE, consolidated=True)
+    WRITE_NETCDF(XARR, OUTFILE, SETTINGS)
+    XARR.close()
+    print('INFO: ZARR_TO_NETCDF: {} converted to {}'.format(OUTSTORE, OUTFILE))
+    return OUTFILE
+
+
+#=============================================================
+#   Manifest of processed files (resumable batches)
+#=============================================================
+# settings which change the output of a file
+manifest_settings = ['use_own_REF', 'XREF', 'YREF', 'use_own_ijk', 'ii', 'jj', 'kk', 'use_own_bbox', 'bbox',
+                     'use_timestep', 'tt', 'custom_variables', 'projection', 'output_format',
+                     'time_averaging', 'time_label', 'continuous_time', 'regions', 'aggregation',
+                     'concatenate', 'concat_name', 'concat_outputs', 'partition',
+                     'use_encoding_profiles', 'time_slab']
+# dictionaries which change the output of a file (content hashed)
+manifest_dictionaries = ['dict_OUTPUT_variables', 'dict_encoding_profiles', 'dict_custom_variables_attributes']
+
+def MANIFEST_CONFIG(METADATA, SETTINGS):
+    """
+    Configuration of a run as stored in the manifest: output relevant settings,
+    sha1 of the metadata spreadsheet, of the dictionaries (manifest_dictionaries)
+    and of the processing code (functions.py), summarised by a sha1 hash.
+    """
+    import hashlib
+    import importlib.util
+
+    config = {key : SETTINGS.get(key) for key in manifest_settings}
+    config['metadata_sha1'] = FILE_HASH(METADATA) if os.path.exists(METADATA) else None
+    for module in manifest_dictionaries:
+        spec = importlib.util.find_spec(module)
+        config[module + '_sha1'] = FILE_HASH(spec.origin) if spec is not None and spec.origin else None
+    config['functions_sha1'] = FILE_HASH(os.path.abspath(__file__))
+    config['hash'] = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+    return config
+
+
+def INPUT_STATE(PATHFILE):
+    """
+    Size and modification time of an input file.
+    """
+    stat = os.stat(PATHFILE)
+    return {'size' : stat.st_size, 'mtime' : stat.st_mtime}
+
+
+def READ_MANIFEST(MANIFEST):
+    """
+    Read the manifest {input file: entry} (empty if it does not exist or is not readable).
+    """
+    try:
+        with open(MANIFEST) as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return {}
+
+
+def WRITE_MANIFEST(MANIFEST, ENTRIES):
+    """
+    Write the manifest to a temporary file and rename it,
+    an interrupted run never leaves a broken manifest.
+    """
+    tmpfile = MANIFEST + '.{}.tmp'.format(os.getpid())
+    with open(tmpfile, 'w') as fid:
+        json.dump(ENTRIES, fid, indent=1, sort_keys=True)
+    os.replace(tmpfile, MANIFEST)
+
+
+def PENDING_FILES(PATH, FILES, CONFIG, ENTRIES):
+    """
+    Files of the batch which have to be processed: not in the manifest,
+    not completed, input changed (size, mtime), other configuration or output missing.
+    """
+    pending = []
+    for infile in FILES:
+        entry = ENTRIES.get(infile, {})
+        if (entry.get('state') == 'done'
+                and entry.get('input') == INPUT_STATE(PATH + infile)
+                and entry.get('config') == CONFIG['hash']
+                and all(os.path.exists(PATH + outfile) for outfile in np.atleast_1d(entry.get('outfile') or ''))):
+            print('INFO: PENDING_FILES: {} is up to date, skipped'.format(infile))
+        else:
+            pending.append(infile)
+    return pending
+
+
+def UPDATE_MANIFEST(MANIFEST, ENTRIES, PATH, RESULT, CONFIG):
+    """
+    Record the state of one file (done/failed) in the manifest and write it.
+    """
+    if not MANIFEST:
+        return
+    ENTRIES[RESULT['file']] = {'state'   : RESULT['status'],
+                               'input'   : INPUT_STATE(PATH + RESULT['file']),
+                               'config'  : CONFIG['hash'],
+                               'metadata_sha1' : CONFIG['metadata_sha1'],
+                               'outfile' : RESULT['outfile'],
+                               'error'   : RESULT.get('error'),
+                               'date'    : datetime.now().isoformat(timespec='seconds')}
+    WRITE_MANIFEST(MANIFEST, ENTRIES)
+
+
+def START_MANIFEST(PATH, FILES, METADATA, SETTINGS):
+    """
+    Load the manifest of SETTINGS['manifest'] (None: no manifest) and
+    select the files which are not up to date.
+    OUTPUT: files, entries, config
+    """
+    if not SETTINGS.get('manifest'):
+        return FILES, {}, None
+    config  = MANIFEST_CONFIG(METADATA, SETTINGS)
+    entries = READ_MANIFEST(SETTINGS['manifest'])
+    files   = PENDING_FILES(PATH, FILES, config, entries)
+    print('INFO: START_MANIFEST: {} of {} files to process'.format(len(files), len(FILES)))
+    return files, entries, config
+
+
+#=============================================================
+#   Processing of single files and batches of files
+#=============================================================
+def PROCESS_FILE(PATH, INFILE, METADATA, SETTINGS):
+    """
+    Run the full conversion chain for one file:
+    READ_FILE -> CROP_DATA -> ... -> to_netcdf
+    (PREPARE_FILE: reading and processing, FINISH_FILE: writing)
+    INPUT: PATH     = directory of the input and output files
+           INFILE   = name of the input file
+           METADATA = Excel-Sheet with global metadata
+           SETTINGS = dictionary with the user input of process_model_data.py
+    OUTPUT: outfile = name of the written file (list for several outputs)
+    """
+    return FINISH_FILE(PATH, PREPARE_FILE(PATH, INFILE, METADATA, SETTINGS), SETTINGS)
+
+
+def PREPARE_FILE(PATH, INFILE, METADATA, SETTINGS, FILES=None):
+    """
+    Read the input and run all processing stages up to the output datasets,
+    the data stay lazy (dask) until FINISH_FILE writes them.
+    INPUT: INFILE = name of the input file (FILES: name of the run, output nc2atmodat_<INFILE>)
+           FILES  = consecutive files of one run, opened as one dataset (READ_FILES), None: INFILE
+    OUTPUT: job = dictionary with infile, outputs {outfile : dataset}, ncid and counters
+    """
+    outfile  = 'nc2atmodat_'+INFILE
+    counters = BEGIN_FILE_RECORD(SETTINGS)
+
+    # Read netCDF-File
+    #-------------------------------------------------------------------------#
+    if FILES:
+        data   = READ_FILES(PATH, FILES, SETTINGS['custom_variables'], MMAP=SETTINGS.get('use_mmap', True),
+                            NTHREADS=SETTINGS.get('open_threads', 4))
+        source = FILES[0]
+    else:
+        data   = READ_FILE(PATH + INFILE, SETTINGS['custom_variables'], MMAP=SETTINGS.get('use_mmap', True))
+        source = INFILE
+
+    # crop data by size or by coordinates
+    #-------------------------------------------------------------------------#
+    projection = GET_PROJECTION(SETTINGS['projection'])
+    if SETTINGS.get('regions'):
+        # several regions: the union is processed, the regions are cut out before writing
+        regions, union = REGION_INDICES(data, SETTINGS['regions'], projection, SETTINGS)
+        own_dims = REGION_OWN_DIMS(data)
+        ncid = CROP_DATA(data, True, *union)
+    elif SETTINGS.get('use_own_bbox', False):
+        ii, jj, kk = BBOX_TO_INDICES(data, SETTINGS['bbox'], projection, SETTINGS['use_own_REF'],
+                                     SETTINGS['XREF'], SETTINGS['YREF'])
+        ncid = CROP_DATA(data, True, ii, jj, kk)
+    else:
+        ncid = CROP_DATA(data, SETTINGS['use_own_ijk'], SETTINGS['ii'], SETTINGS['jj'], SETTINGS['kk'])
+    ncid = CROP_TIME(ncid, SETTINGS['use_timestep'], SETTINGS['tt'])
+
+    # grid properties (orography, staggering, ...) used by the next steps
+    #-------------------------------------------------------------------------#
+    profile = GRID_PROFILE(ncid)
+
+    # Create dimensions i,j,k
+    #-------------------------------------------------------------------------#
+    ncid = REASSIGN_DIMENSIONS(ncid, profile)
+    ncid = CREATE_BOUNDS(ncid, profile)
+
+    # Create time bounds
+    #-------------------------------------------------------------------------#
+    ncid = ADD_TIME_ATTRS(ncid)
+    previous, following = SETTINGS.get('time_neighbours', {}).get(INFILE, (None, None))
+    ncid = ASSIGN_TIME_BOUNDS(ncid, previous, following, SETTINGS.get('time_averaging'),
+                              SETTINGS.get('time_label', 'end'))
+
+    # Add UTM and geographic coordinate
+    #-------------------------------------------------------------------------#
+    # Projection: universal transversal mercator (created once per process, see above)
+    ncid       = GEOCOORDINATES(ncid, projection, SETTINGS['use_own_REF'], SETTINGS['XREF'], SETTINGS['YREF'],
+                                SETTINGS['cache_dir'], SETTINGS['use_coordinate_cache'], profile)
+    #ncid       = GEOCOORDINATES_VECTOR(ncid, projection, SETTINGS['use_own_REF'], SETTINGS['XREF'], SETTINGS['YREF'],
+    #                                   SETTINGS['cache_dir'], SETTINGS['use_coordinate_cache'], profile)  # optional
+    ncid       = SET_ijk_TO_xyz(ncid, profile)
+    ncid       = CELL_METHODS(ncid)
+    #ncid       = ADD_CELL_METHODS(ncid)    # optional
+
+    # Select Output Variables
+    #-------------------------------------------------------------------------#
+    ncoutput = SELECT_OUTPUT_VARIABLES(ncid, SETTINGS['custom_variables'])
+    ncoutput = ADD_CUSTOM_ATTRIBUTES_TO_VARIABLES(ncoutput)
+    ncoutput = CORRECTION_VARIABLE_ATTRIBUTES(ncoutput)
+
+    # Global Attributes
+    #-------------------------------------------------------------------------#
+    ncoutput.attrs            = ADD_GLOBAL_ATTRS(METADATA, SETTINGS['cache_dir'])
+    ncoutput.attrs['history'] = ADD_GLOBAL_HISTORY_ATTRS(PATH + source)
+    ncoutput                  = DELETE_GLOBAL_ATTRS(ncoutput)
+
+    # OPTIONAL: Grid Mapping and Projection (TODO)
+    #-------------------------------------------------------------------------#
+    #! INFO: only required if lat, lon are not in the dataset.
+    #! See more info at the function.
+    # XARR = GRID_MAPPING(XARR, PROJECTION) <---- WIP
+
+    # save file, end processing:
+    #-------------------------------------------------------------------------#
+    # one output per region, aggregated products (hourly means, ...) of each output
+    if SETTINGS.get('regions'):
+        outputs = {'nc2atmodat_{}_{}'.format(name, INFILE) : REGION_SUBSET(ncoutput, regions[name], union, own_dims)
+                   for name in regions}
+    else:
+        outputs = {outfile : ncoutput}
+    if SETTINGS.get('aggregation'):
+        sampling = SAMPLING_INTERVAL(ncoutput, SETTINGS.get('time_averaging'))
+        outputs.update(AGGREGATE_OUTPUTS(outputs, SETTINGS['aggregation'], sampling))
+    if FILES and SETTINGS.get('concat_outputs', 1) > 1:
+        outputs = SPLIT_OUTPUTS(outputs, SETTINGS['concat_outputs'])
+    return {'infile' : INFILE, 'outputs' : outputs, 'ncid' : ncid, 'counters' : counters,
+            'instrumentation' : dict(INSTRUMENTATION())}
+
+
+def FINISH_FILE(PATH, JOB, SETTINGS):
+    """
+    Write the outputs of a prepared file (PREPARE_FILE), close the input
+    and record the instrumentation of the file.
+    OUTPUT: outfile = name of the written file (list for several outputs)
+    """
+    # the file may have been prepared by another thread (PROCESS_FILES, pipeline)
+    INSTRUMENTATION().update(JOB['instrumentation'])
+    outfile = WRITE_OUTPUTS(JOB['outputs'], PATH, SETTINGS)
+    JOB['ncid'].close()
+    for XARR in JOB['outputs'].values():
+        XARR.close()
+    END_FILE_RECORD(JOB['counters'], JOB['infile'], outfile, SETTINGS)
+    #-------------------------------------------------------------------------#
+    print('Finished \n file can be found here:\n ' + '\n '.join(PATH + name for name in np.atleast_1d(outfile)))
+    return outfile
+
+
+def SPLIT_OUTPUTS(OUTPUTS, NPARTS):
+    """
+    Split the outputs along time into NPARTS files of (nearly) equal length,
+    nc2atmodat_<name>_01.nc, nc2atmodat_<name>_02.nc, ...
+    time_bnds are those of the whole run, consecutive files share their bounds.
+    """
+    split = {}
+    for outfile, XARR in OUTPUTS.items():
+        if 'time' not in XARR.dims:
+            split[outfile] = XARR
+            continue
+        nparts = min(NPARTS, XARR.sizes['time'])
+        edges  = np.linspace(0, XARR.sizes['time'], nparts + 1).round().astype(int)
+        stem, ext = os.path.splitext(outfile)
+        for n, (first, last) in enumerate(zip(edges[:-1], edges[1:])):
+            split['{}_{:02d}{}'.format(stem, n + 1, ext)] = XARR.isel(time=slice(first, last))
+    return split
+
+
+def WRITE_OUTPUT(XARR, PATH, OUTFILE, SETTINGS):
+    """
+    Write the output dataset as netCDF, streamed netCDF (time_slab) or zarr store.
+    Written to <outfile>.part and renamed when complete:
+    an interrupted run leaves no incomplete output under the final name.
+    OUTPUT: name of the written file or store
+    """
+    if SETTINGS.get('output_format', 'netcdf') == 'zarr':
+        outstore = os.path.splitext(OUTFILE)[0] + '.zarr'
+        WRITE_ZARR(XARR, PATH + outstore + '.part', SETTINGS)
+        if SETTINGS.get('zarr_to_netcdf', False):
+            ZARR_TO_NETCDF(PATH + outstore + '.part', PATH + OUTFILE + '.part', SETTINGS)
+            COMPLETE_OUTPUT(PATH + OUTFILE)
+        else:
+            OUTFILE = outstore
+        COMPLETE_OUTPUT(PATH + outstore)
+    elif SETTINGS.get('time_slab') and 'time' in XARR.dims:
+        WRITE_NETCDF_STREAMING(XARR, PATH + OUTFILE + '.part', SETTINGS)
+        COMPLETE_OUTPUT(PATH + OUTFILE)
+    else:
+        WRITE_NETCDF(XARR, PATH + OUTFILE + '.part', SETTINGS)
+        COMPLETE_OUTPUT(PATH + OUTFILE)
+    return OUTFILE
+
+
+def WRITE_OUTPUTS(OUTPUTS, PATH, SETTINGS):
+    """
+    Write the outputs of one input file (regions, aggregated products).
+    Several netCDF outputs are written in one dask computation (WRITE_NETCDF_ONE_PASS),
+    input chunks shared by the outputs are read once.
+    With SETTINGS['partition'] each output is split into files per time period (WRITE_PARTITIONS).
+    INPUT: OUTPUTS = {outfile : dataset}
+    OUTPUT: name of the written file, list of names for several outputs
+    """
+    if SETTINGS.get('partition'):
+        outfiles = WRITE_PARTITIONS(OUTPUTS, PATH, SETTINGS)
+    elif len(OUTPUTS) == 1 or SETTINGS.get('output_format', 'netcdf') == 'zarr' or SETTINGS.get('time_slab'):
+        outfiles = [WRITE_OUTPUT(XARR, PATH, outfile, SETTINGS) for outfile, XARR in OUTPUTS.items()]
+    else:
+        WRITE_NETCDF_ONE_PASS({PATH + outfile + '.part' : XARR for outfile, XARR in OUTPUTS.items()}, SETTINGS)
+        outfiles = list(OUTPUTS)
+        for outfile in outfiles:
+            COMPLETE_OUTPUT(PATH + outfile)
+    return outfiles[0] if len(outfiles) == 1 else outfiles
+
+
+def OUTPUT_NAMES(INFILE, SETTINGS):
+    """
+    Names of the outputs of INFILE: nc2atmodat_<file>, one per region: nc2atmodat_<region>_<file>,
+    aggregated products: nc2atmodat_<window>_<method>_<...> (see AGGREGATE_OUTPUTS),
+    outputs of a run split along time: nc2atmodat_<...>_<nn> (see SPLIT_OUTPUTS, possibly fewer).
+    """
+    if not SETTINGS.get('regions'):
+        outfiles = ['nc2atmodat_' + INFILE]
+    else:
+        outfiles = ['nc2atmodat_{}_{}'.format(name, INFILE) for name in SETTINGS['regions']]
+    outfiles += [outfile.replace('nc2atmodat_', 'nc2atmodat_' + name + '_', 1)
+                 for outfile in outfiles for name in AGGREGATION_NAMES(SETTINGS.get('aggregation'))]
+    if SETTINGS.get('concatenate') and SETTINGS.get('concat_outputs', 1) > 1:
+        outfiles = ['{}_{:02d}{}'.format(os.path.splitext(outfile)[0], n + 1, os.path.splitext(outfile)[1])
+                    for outfile in outfiles for n in range(SETTINGS['concat_outputs'])]
+    return outfiles
+
+
+#=============================================================
+#   Time-partitioned output (one file per period, concurrent writers)
+#=============================================================
+def PARTITIONS(XARR, PARTITION):
+    """
+    Time steps of the partitions of an output: periods aligned to the clock
+    (PARTITION = '1h', '1D', ...) or PARTITION time steps per file (integer).
+    OUTPUT: list of slices
+    """
+    ntime = XARR.sizes['time']
+    if isinstance(PARTITION, (int, np.integer)):
+        return [slice(first, min(first + int(PARTITION), ntime)) for first in range(0, ntime, int(PARTITION))]
+    return TIME_WINDOWS(XARR.time.values, PARTITION)
+
+
+def PARTITION_INDEX_NAME(OUTFILE):
+    """
+    Name of the index of a partitioned output: nc2atmodat_<...>_index.json
+    """
+    return os.path.splitext(OUTFILE)[0] + '_index.json'
+
+
+def RUN_PARTITION_WORKER(XARR, PATH, OUTFILE, SETTINGS):
+    """
+    Write one partition inside a worker of WRITE_PARTITIONS (WRITE_OUTPUT),
+    errors are returned.
+    OUTPUT: dictionary with file, status, error and runtime in seconds
+    """
+    start  = datetime.now()
+    result = {'file' : OUTFILE, 'status' : 'done', 'error' : None}
+    try:
+        result['file'] = WRITE_OUTPUT(XARR, PATH, OUTFILE, SETTINGS)
+    except MemoryError:
+        result['status'] = 'failed'
+        result['error']  = 'MemoryError: worker memory limit exceeded'
+    except (Exception, SystemExit) as err:
+        result['status'] = 'failed'
+        result['error']  = '{}: {}'.format(type(err).__name__, err)
+    result['seconds'] = (datetime.now() - start).total_seconds()
+    return result
+
+
+@INSTRUMENT
+def WRITE_PARTITIONS(OUTPUTS, PATH, SETTINGS):
+    """
+    Split each output along time into one file per period (PARTITIONS),
+    nc2atmodat_<...>_<start YYYYmmddTHHMMSS>.nc. The partitions are written concurrently
+    by SETTINGS['partition_workers'] processes (spawned), each with its own file handle.
+    Each partition keeps the time_bnds of its time steps (shared with the neighbours),
+    the global attributes of the output and a history entry. An index
+    (nc2atmodat_<...>_index.json) lists the partitions and their time ranges.
+    OUTPUT: list of the written partitions
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    # the workers write single files
+    settings = dict(SETTINGS, partition=None)
+    jobs     = {}
+    for outfile, XARR in OUTPUTS.items():
+        if 'time' not in XARR.dims:
+            jobs[outfile] = (outfile, XARR, None)
+            continue
+        parts = PARTITIONS(XARR, SETTINGS['partition'])
+        stem, ext = os.path.splitext(outfile)
+        for n, part in enumerate(parts):
+            partition = XARR.isel(time=part)
+            start = pd.Timestamp(partition.time.values[0]).strftime('%Y%m%dT%H%M%S')
+            name  = '{}_{}{}'.format(stem, start, ext)
+            if name in jobs:
+                print('ERROR: WRITE_PARTITIONS: partitions {} and {} of {} start at the same time ({}). Stopping program.'.format(
+                      jobs[name][2] + 1, n + 1, outfile, start))
+                raise SystemExit(1)
+            partition.attrs = dict(XARR.attrs)
+            partition.attrs['history'] = XARR.attrs.get('history', '') + '\n{}: partition {} of {} of {} (time steps {} to {})'.format(
+                datetime.now().strftime('%a %b %d %Y'), n + 1, len(parts), outfile, part.start, part.stop - 1)
+            jobs[name] = (outfile, partition, n)
+
+    nworkers = max(1, min(SETTINGS.get('partition_workers', 4), len(jobs)))
+    print('INFO: WRITE_PARTITIONS: writing {} partitions with {} workers'.format(len(jobs), nworkers))
+    results = {}
+    # spawn: forking a process with running threads (dask, PREPARE_AHEAD, batch workers) deadlocks
+    with ProcessPoolExecutor(max_workers=nworkers, initializer=INIT_BATCH_WORKER, initargs=(None, 1),
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {name : pool.submit(RUN_PARTITION_WORKER, partition, PATH, name, settings)
+                   for name, (outfile, partition, n) in jobs.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except BrokenProcessPool:
+                results[name] = {'file' : name, 'status' : 'failed', 'error' : 'worker process terminated abruptly'}
+
+    # index of the partitions of each output
+    for outfile in OUTPUTS:
+        index = [{'file' : results[name]['file'], 'status' : results[name]['status'],
+                  'time_start' : str(partition.time.values[0]), 'time_end' : str(partition.time.values[-1]),
+                  'time_bnds' : [str(partition.time_bnds.values[0, 0]), str(partition.time_bnds.values[-1, 1])]
+                                if 'time_bnds' in partition.variables else None,
+                  'time_steps' : int(partition.sizes['time'])}
+                 for name, (output, partition, n) in jobs.items() if output == outfile and n is not None]
+        if index:
+            # written like the manifest: temporary file, then renamed
+            WRITE_MANIFEST(PATH + PARTITION_INDEX_NAME(outfile), {'output' : outfile, 'partition' : str(SETTINGS['partition']),
+                                                                'partitions' : index})
+
+    failed = [res for res in results.values() if res['status'] != 'done']
+    for res in failed:
+        print('ERROR: WRITE_PARTITIONS: {}: {}'.format(res['file'], res['error']))
+    if failed:
+        print('ERROR: WRITE_PARTITIONS: {} of {} partitions failed. Stopping program.'.format(len(failed), len(results)))
+        raise SystemExit(1)
+    return [res['file'] for res in results.values()]
+
+
+def PARTITION_FILES(PATH, OUTFILE):
+    """
+    Partitions of an output listed in its index (PARTITION_INDEX_NAME), [OUTFILE] without index.
+    """
+    index = READ_MANIFEST(PATH + PARTITION_INDEX_NAME(OUTFILE))
+    if not index:
+        return [OUTFILE]
+    return [entry['file'] for entry in index['partitions']]
+
+
+def COMPLETE_OUTPUT(OUTFILE):
+    """
+    Rename the completely written OUTFILE.part (file or zarr store) to OUTFILE.
+    """
+    import shutil
+
+    if os.path.isdir(OUTFILE):
+        shutil.rmtree(OUTFILE)
+    os.replace(OUTFILE + '.part', OUTFILE)
+
+
+def INIT_BATCH_WORKER(MEMORY_LIMIT, THREADS):
+    """
+    Initialise a worker process of the batch pool.
+    MEMORY_LIMIT = memory cap per worker in GB (None: no limit)
+    THREADS      = number of dask threads per worker
+    The memory cap is set with the resource module (Linux/Unix only),
+    a worker exceeding it fails with a MemoryError instead of exhausting the RAM.
+    """
+    if MEMORY_LIMIT:
+        try:
+            import resource
+            nbytes = int(MEMORY_LIMIT * 1024**3)
+            # RLIMIT_DATA does not count file mappings of the input
+            resource.setrlimit(resource.RLIMIT_DATA, (nbytes, nbytes))
+        except (ImportError, ValueError, OSError):
+            print('INFO: INIT_BATCH_WORKER: memory limit could not be set on this system')
+
+    # avoid N workers x all cores dask threads
+    import dask
+    dask.config.set(scheduler='threads', num_workers=THREADS)
+
+
+def RUN_BATCH_WORKER(PATH, INFILE, METADATA, SETTINGS):
+    """
+    Process one file inside a worker of the batch pool.
+    Errors are caught and returned, so that one broken file does not stop the batch.
+    OUTPUT: dictionary with file, status, outfile, error and runtime in seconds
+    """
+    start  = datetime.now()
+    result = {'file' : INFILE, 'status' : 'done', 'outfile' : None, 'error' : None, 'record' : None}
+    try:
+        result['outfile'] = PROCESS_FILE(PATH, INFILE, METADATA, SETTINGS)
+        result['record']  = INSTRUMENTATION()['file_record']
+    except MemoryError:
+        result['status'] = 'failed'
+        result['error']  = 'MemoryError: worker memory limit exceeded'
+    # SystemExit is raised by the stages if the input is not valid
+    except (Exception, SystemExit) as err:
+        result['status'] = 'failed'
+        result['error']  = '{}: {}'.format(type(err).__name__, err)
+    result['seconds'] = (datetime.now() - start).total_seconds()
+    return result
+
+
+def PROCESS_FILES_PARALLEL(PATH, FILES, METADATA, SETTINGS, NWORKERS=4, MEMORY_LIMIT=None, THREADS=1):
+    """
+    Batch mode: spread the files over a pool of NWORKERS processes.
+    Each worker runs the full chain (PROCESS_FILE) for one file at a time.
+    Failures are isolated per file and reported at the end (REPORT_BATCH).
+    Files which are up to date in the manifest are skipped (START_MANIFEST).
+    INPUT: MEMORY_LIMIT = memory cap per worker in GB (None: no limit)
+           THREADS      = number of dask threads per worker
+    OUTPUT: results = list of dictionaries (see RUN_BATCH_WORKER)
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+
+    files, entries, config = START_MANIFEST(PATH, FILES, METADATA, SETTINGS)
+    if SETTINGS.get('continuous_time', False):
+        SETTINGS = dict(SETTINGS, time_neighbours=TIME_NEIGHBOURS(PATH, FILES))
+    nworkers = max(1, min(NWORKERS, len(files)))
+    print('INFO: PROCESS_FILES_PARALLEL: processing {} files with {} workers'.format(len(files), nworkers))
+
+    start   = datetime.now()
+    results = []
+    # spawn: the parent may hold netCDF/HDF5 handles and dask threads (see WRITE_PARTITIONS)
+    with ProcessPoolExecutor(max_workers=nworkers, initializer=INIT_BATCH_WORKER, initargs=(MEMORY_LIMIT, THREADS),
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        jobs = {pool.submit(RUN_BATCH_WORKER, PATH, infile, METADATA, SETTINGS) : infile
+                for infile in files}
+        for job in as_completed(jobs):
+            try:
+                result = job.result()
+            except BrokenProcessPool:
+                # worker was killed (e.g. by the OOM killer)
+                result = {'file' : jobs[job], 'status' : 'failed', 'outfile' : None,
+                          'error' : 'worker process terminated abruptly', 'seconds' : None, 'record' : None}
+            print('INFO: PROCESS_FILES_PARALLEL: {} {}'.format(result['file'], result['status']))
+            UPDATE_MANIFEST(SETTINGS.get('manifest'), entries, PATH, result, config)
+            results.append(result)
+
+    REPORT_BATCH(results)
+    BATCH_RECORD(results, (datetime.now() - start).total_seconds(), SETTINGS, nworkers)
+    return results
+
+
+def PROCESS_FILES(PATH, FILES, METADATA, SETTINGS):
+    """
+    Convert the files one after the other (PROCESS_FILE).
+    Files which are up to date in the manifest are skipped (START_MANIFEST).
+    With SETTINGS['pipeline_depth'] > 0 the next files are read and processed
+    (PREPARE_FILE) in a background thread while the current file is written
+    (FINISH_FILE), see PREPARE_AHEAD. Not used with SETTINGS['partition']
+    (WRITE_PARTITIONS writes concurrently itself).
+    Errors stop the program as before, the batch summary of the
+    instrumentation is written at the end (BATCH_RECORD).
+    OUTPUT: results = list of dictionaries (file, status, outfile, record)
+    """
+    files, entries, config = START_MANIFEST(PATH, FILES, METADATA, SETTINGS)
+    if SETTINGS.get('continuous_time', False):
+        SETTINGS = dict(SETTINGS, time_neighbours=TIME_NEIGHBOURS(PATH, FILES))
+    start   = datetime.now()
+    results = []
+    depth   = 0 if SETTINGS.get('partition') else SETTINGS.get('pipeline_depth', 0)
+    jobs    = PREPARE_AHEAD(PATH, files, METADATA, SETTINGS, depth)
+    try:
+        for infile in files:
+            result = {'file' : infile, 'status' : 'failed', 'outfile' : None, 'record' : None}
+            try:
+                job = next(jobs)
+                result['outfile'] = FINISH_FILE(PATH, job, SETTINGS)
+                result['status']  = 'done'
+                result['record']  = INSTRUMENTATION()['file_record']
+            finally:
+                UPDATE_MANIFEST(SETTINGS.get('manifest'), entries, PATH, result, config)
+            results.append(result)
+    finally:
+        jobs.close()
+    BATCH_RECORD(results, (datetime.now() - start).total_seconds(), SETTINGS)
+    return results
+
+
+def PREPARE_AHEAD(PATH, FILES, METADATA, SETTINGS, DEPTH=1):
+    """
+    Generator of prepared files (PREPARE_FILE) in the order of FILES.
+    DEPTH > 0: a background thread opens and processes the next files while the
+    caller writes the current one, so reading, the static stages (grid, bounds,
+    coordinates) and writing overlap. At most DEPTH prepared files wait in the queue
+    (bounded memory: only the static arrays, the data stay lazy).
+    DEPTH = 0: each file is prepared when it is needed.
+    Errors of PREPARE_FILE are raised when the file is requested.
+    """
+    import queue
+
+    if not DEPTH:
+        for infile in FILES:
+            yield PREPARE_FILE(PATH, infile, METADATA, SETTINGS)
+        return
+
+    prepared = queue.Queue(maxsize=DEPTH)
+    stop     = threading.Event()
+
+    def PREPARE_WORKER():
+        for infile in FILES:
+            if stop.is_set():
+                return
+            try:
+                item = ('job', PREPARE_FILE(PATH, infile, METADATA, SETTINGS))
+            except BaseException as err:
+                item = ('error', err)
+            # wait for a free place in the queue, give up if the batch was stopped
+            while not stop.is_set():
+                try:
+                    prepared.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+            if item[0] == 'error':
+                return
+
+    worker = threading.Thread(target=PREPARE_WORKER, name='nc2atmodat-prepare', daemon=True)
+    worker.start()
+    try:
+        for infile in FILES:
+            kind, item = prepared.get()
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        # batch stopped or finished: release the worker and close the files prepared ahead
+        stop.set()
+        while worker.is_alive() or not prepared.empty():
+            try:
+                kind, item = prepared.get(timeout=0.5)
+                if kind == 'job':
+                    item['ncid'].close()
+            except queue.Empty:
+                pass
+        worker.join()
+
+
+def PROCESS_RUN(PATH, FILES, METADATA, SETTINGS):
+    """
+    Multi-file mode: FILES are consecutive parts of one model run. They are opened
+    as one dataset (READ_FILES), the static stages (grid, bounds, coordinates, metadata)
+    run once and one continuous output nc2atmodat_<concat_name> is written, or
+    concat_outputs outputs split along time (SPLIT_OUTPUTS), in one dask computation.
+    The manifest is not used, the run is converted as a whole.
+    OUTPUT: outfile = name of the written file (list for several outputs)
+    """
+    start  = datetime.now()
+    result = {'file' : SETTINGS['concat_name'], 'status' : 'failed', 'outfile' : None, 'record' : None}
+    try:
+        job = PREPARE_FILE(PATH, SETTINGS['concat_name'], METADATA, SETTINGS, FILES)
+        result['outfile'] = FINISH_FILE(PATH, job, SETTINGS)
+        result['status']  = 'done'
+        result['record']  = INSTRUMENTATION()['file_record']
+    finally:
+        BATCH_RECORD([result], (datetime.now() - start).total_seconds(), SETTINGS)
+    return result['outfile']
+
+
+def REPORT_BATCH(RESULTS):
+    """
+    Print a summary of a batch run: converted and failed files.
+    """
+    failed = [res for res in RESULTS if res['status'] != 'done']
+    print('INFO: REPORT_BATCH: {} of {} files converted'.format(len(RESULTS) - len(failed), len(RESULTS)))
+    for res in failed:
+        print('ERROR: {}: {}'.format(res['file'], res['error']))
+
+
+#=============================================================
+#   Metadata update of existing outputs (no data rewrite)
+#=============================================================
+def APPLY_ATTRS(NCOBJ, OLD, NEW):
+    """
+    Write the changed attributes of NEW to a netCDF4 dataset or variable,
+    delete the attributes missing in NEW. Reserved attributes (_FillValue, ...) are kept.
+    OUTPUT: number of changed attributes
+    """
+    def equal(A, B):
+        try:
+            # empty cells of the spreadsheet are NaN
+            return np.array_equal(A, B, equal_nan=True)
+        except TypeError:
+            return np.array_equal(A, B)
+
+    changes = 0
+    for key, value in NEW.items():
+        if key.startswith('_'):
+            continue
+        if key not in OLD or not equal(OLD[key], value):
+            NCOBJ.setncattr(key, value)
+            changes += 1
+    for key in OLD:
+        if key not in NEW and not key.startswith('_'):
+            NCOBJ.delncattr(key)
+            changes += 1
+    return changes
+
+
+@INSTRUMENT
+def UPDATE_METADATA(OUTFILE, GLOBAL_ATTRS):
+    """
+    Metadata-only fast path: apply the attribute stages
+    (ADD_CUSTOM_ATTRIBUTES_TO_VARIABLES, CELL_METHODS, CORRECTION_VARIABLE_ATTRIBUTES,
+    global attributes, DELETE_GLOBAL_ATTRS) to an existing output file.
+    Only the changed attributes are written in place (netCDF4, mode r+),
+    the data of the variables is neither read nor rewritten.
+    INPUT: OUTFILE      = converted file (nc2atmodat_*.nc)
+           GLOBAL_ATTRS = global attributes (ADD_GLOBAL_ATTRS)
+    OUTPUT: number of changed attributes
+    """
+    import netCDF4
+
+    # header only: without decoding no data is loaded
+    with xr.open_dataset(OUTFILE, decode_cf=False) as XARR:
+        old_global = dict(XARR.attrs)
+        old_attrs  = {var : dict(XARR[var].attrs) for var in XARR.variables}
+
+        XARR = ADD_CUSTOM_ATTRIBUTES_TO_VARIABLES(XARR)
+        XARR = CELL_METHODS(XARR)
+        XARR = CORRECTION_VARIABLE_ATTRIBUTES(XARR)
+
+        XARR.attrs = dict(GLOBAL_ATTRS)
+        # data was created with the first conversion
+        for key in ['creation_date', 'history']:
+            if key in old_global:
+                XARR.attrs[key] = old_global[key]
+        # aggregated products (AGGREGATE_TIME) keep the frequency of their windows
+        if 'aggregation' in old_global:
+            for key in ['aggregation', 'frequency']:
+                if key in old_global:
+                    XARR.attrs[key] = old_global[key]
+        XARR.attrs['history'] = XARR.attrs.get('history', '') + '\n{}: metadata updated with nc2atmodat.py'.format(
+                                datetime.now().strftime('%a %b %d %Y'))
+        XARR = DELETE_GLOBAL_ATTRS(XARR)
+        new_global = dict(XARR.attrs)
+        new_attrs  = {var : dict(XARR[var].attrs) for var in XARR.variables}
+
+    changes = 0
+    with netCDF4.Dataset(OUTFILE, 'r+') as ncfile:
+        changes += APPLY_ATTRS(ncfile, old_global, new_global)
+        for var, attrs in new_attrs.items():
+            if var in ncfile.variables:
+                changes += APPLY_ATTRS(ncfile[var], old_attrs.get(var, {}), attrs)
+    print('INFO: UPDATE_METADATA: {} attributes of {} updated'.format(changes, OUTFILE))
+    return changes
+
+
+def RUN_METADATA_WORKER(OUTFILE, GLOBAL_ATTRS):
+    """
+    Update one file inside a worker of UPDATE_METADATA_FILES, errors are returned.
+    """
+    result = {'file' : OUTFILE, 'status' : 'done', 'changes' : None, 'error' : None}
+    try:
+        result['changes'] = UPDATE_METADATA(OUTFILE, GLOBAL_ATTRS)
+    except (Exception, SystemExit) as err:
+        result['status'] = 'failed'
+        result['error']  = '{}: {}'.format(type(err).__name__, err)
+    return result
+
+
+def UPDATE_METADATA_FILES(PATH, FILES, METADATA, SETTINGS, NWORKERS=4):
+    """
+    Update the metadata of the outputs (nc2atmodat_<file>, see OUTPUT_NAMES) of FILES in parallel
+    (UPDATE_METADATA), e.g. after a change of the metadata spreadsheet or of
+    dict_custom_variables_attributes.py. The spreadsheet is parsed once.
+    INPUT: FILES = input file names, None: all nc2atmodat_*.nc files in PATH
+    OUTPUT: results = list of dictionaries (file, status, changes, error)
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if FILES is None:
+        outfiles = sorted(name for name in os.listdir(PATH) if name.startswith('nc2atmodat_') and name.endswith('.nc'))
+    else:
+        # multi-file run: outputs of the run (PROCESS_RUN)
+        if SETTINGS.get('concatenate'):
+            FILES = [SETTINGS['concat_name']]
+        outfiles = [partition for infile in FILES for outfile in OUTPUT_NAMES(infile, SETTINGS)
+                    for partition in PARTITION_FILES(PATH, outfile) if os.path.exists(PATH + partition)]
+    attrs = ADD_GLOBAL_ATTRS(METADATA, SETTINGS.get('cache_dir'))
+
+    nworkers = max(1, min(NWORKERS, len(outfiles)))
+    print('INFO: UPDATE_METADATA_FILES: updating {} files with {} workers'.format(len(outfiles), nworkers))
+    with ProcessPoolExecutor(max_workers=nworkers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        results = list(pool.map(RUN_METADATA_WORKER, [PATH + outfile for outfile in outfiles],
+                                [attrs] * len(outfiles)))
+    REPORT_BATCH(results)
+    return results
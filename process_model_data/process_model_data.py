@@ -36,12 +36,133 @@ kk = [0,50]
 
 use_timestep = False
 tt = [0,3]
+
+# crop domain by coordinates instead of indices (replaces ii, jj, kk)
+#    True/False, default: False
+#    crs: 'utm' (m), 'latlon' (degrees) or 'model' (m, model grid)
+#    z: height above ground in m (optional)
+use_own_bbox = False
+bbox = {'crs' : 'utm',
+        'x'   : [565000., 567000.],
+        'y'   : [5933000., 5935000.],
+        'z'   : [0., 100.]}
+
+# several regions in one pass: one output per region (nc2atmodat_<name>_<file>),
+# the file is read and processed once (replaces ii, jj, kk and bbox)
+#    each region by indices (ii, jj, kk) or by coordinates (bbox), None: one output
+regions = None
+#regions = {'region1' : {'ii' : [9, 200], 'jj' : [12, 200], 'kk' : [0, 50]},
+#           'region2' : {'bbox' : {'crs' : 'utm', 'x' : [565000., 566000.], 'y' : [5934000., 5935000.]}}}
 #-----------------------------------------------------------------------------#
 # 3) add additional variables to output (name)
 #    comma separated list: ['var1', 'var2', ...]
 custom_variables = [] #['tket']
 #
 #-----------------------------------------------------------------------------#
+# 4) batch mode: convert the files in parallel
+#    True/False, default: False
+use_parallel = False
+nworkers     = 4     # number of worker processes
+memory_limit = None  # memory cap per worker in GB, None: no limit
+nthreads     = 1     # dask threads per worker
+#    sequential mode: number of files read and processed ahead while the current
+#    file is written (reading, processing and writing overlap), 0: one after the other
+#    (default, needs memory for pipeline_depth + 1 files; not used with partition)
+pipeline_depth = 0
+#
+#-----------------------------------------------------------------------------#
+# 5) output chunking: size of one chunk and available memory
+#    chunks are planned for each output variable (see PLAN_CHUNKS)
+chunk_MB  = 16       # target size of one chunk in MB
+memory_MB = None     # memory budget in MB, None: no limit
+#
+#    streaming: write time_slab time steps at a time (appended along time),
+#    memory is bounded by one slab, None: write all time steps at once
+time_slab = None
+#
+#    netCDF3 input files (classic, 64-bit offset) are memory-mapped
+use_mmap  = True
+#
+#-----------------------------------------------------------------------------#
+# 6) compression and dtype of the output variables (dict_encoding_profiles.py)
+#    True/False, default: True
+use_encoding_profiles = True
+encoding_report       = True   # print compression ratio and write throughput
+#
+#-----------------------------------------------------------------------------#
+# 7) output format: 'netcdf' or 'zarr' (store with consolidated metadata)
+#    default: 'netcdf'
+output_format  = 'netcdf'
+zarr_to_netcdf = False   # convert the zarr store to netCDF4 for archival
+#
+#-----------------------------------------------------------------------------#
+# 8) projection of the model domain (pyproj) and cache directory
+#    lat/lon grids are cached on disk and reused by later files and runs
+#    of the same domain, None: cache in memory only
+#    use_coordinate_cache = False: lat/lon are computed block-wise while writing
+projection = {'proj' : 'utm', 'zone' : 32, 'ellps' : 'WGS84', 'preserve_units' : False}
+cache_dir  = path + '.nc2atmodat_cache/'
+use_coordinate_cache = True
+#
+#-----------------------------------------------------------------------------#
+# 9) instrumentation: runtime, CPU time, peak memory and I/O of each step
+#    written as JSON lines per file and per batch to instrument_log
+#    True/False, default: False
+instrumentation = False
+instrument_log  = path + 'nc2atmodat_stages.jsonl'
+#
+#-----------------------------------------------------------------------------#
+# 10) resume: files which were converted with the same settings, metadata and
+#     code and did not change since are skipped (manifest of processed files),
+#     None: always convert all files (default)
+manifest = None
+#manifest = path + 'nc2atmodat_manifest.json'
+#
+#-----------------------------------------------------------------------------#
+# 11) update only the metadata of existing outputs (nc2atmodat_<file>)
+#     after changes of the metadata spreadsheet or of the variable attributes,
+#     the data is not rewritten (uses nworkers processes)
+#     True/False, default: False
+metadata_only = False
+#
+#-----------------------------------------------------------------------------#
+# 12) time bounds: midpoints between the time steps (irregular steps allowed)
+#     or the averaging interval of the model output, e.g. '10min' (None: midpoints)
+time_averaging  = None
+time_label      = 'end'   # time stamp at the 'end', 'start' or 'center' of the interval
+#     files are consecutive parts of one run: bounds continue across the files
+#     True/False, default: False
+continuous_time = False
+#
+#-----------------------------------------------------------------------------#
+# 13) temporal aggregation: products with one value per time window written
+#     together with the full output (one read pass), one file per window and method
+#     nc2atmodat_<window>_<method>_<file>, e.g. nc2atmodat_1h_mean_file1.nc
+#     windows: '1h', '1D', ... (aligned to the clock)
+#     methods: 'mean', 'min', 'max', 'median', 'p<N>' (N-th percentile, e.g. 'p95')
+#     label:   time stamp at the 'end', 'start' or 'center' of the window
+#     None: no aggregation
+aggregation = None
+#aggregation = {'windows' : ['1h'], 'methods' : ['mean', 'max', 'p95'], 'label' : 'end'}
+#
+#-----------------------------------------------------------------------------#
+# 14) multi-file run: the files are consecutive parts of one model run with the
+#     same grid, they are opened as one dataset and converted in one pass
+#     to nc2atmodat_<concat_name>, or to concat_outputs files split along time
+#     True/False, default: False
+concatenate    = False
+concat_name    = 'run.nc'
+concat_outputs = 1
+#
+#-----------------------------------------------------------------------------#
+# 15) time-partitioned output: one file per period, written concurrently
+#     '1h', '1D', ... (aligned to the clock) or number of time steps per file,
+#     nc2atmodat_<...>_<YYYYmmddTHHMMSS>.nc, index: nc2atmodat_<...>_index.json
+#     None: one file
+partition         = None
+partition_workers = 4     # number of writer processes
+#
+#-----------------------------------------------------------------------------#
 # END User Input 
 #=============================================================================#
 
@@ -54,82 +175,62 @@ from datetime import datetime
 from dask.diagnostics import ProgressBar
 #-----------------------------------------------------------------------------#
 # load custom modules
-from dict_MEMI_record_numbers import *
+from dict_OUTPUT_variables import *
 from functions import *
 #-----------------------------------------------------------------------------#
 
-
-for infile in files:
-    outfile  = 'nc2atmodat_'+infile
-
-
-    # Read netCDF-File
-    #-------------------------------------------------------------------------#
-    data = READ_FILE(path + infile)
-
-
-    # crop data by size
-    #-------------------------------------------------------------------------#
-    ncid = CROP_DATA(data, use_own_ijk, ii, jj, kk)
-    ncid = CROP_TIME(ncid, use_timestep, tt)
-
-
-    # Create dimensions i,j,k
-    #-------------------------------------------------------------------------#
-    ncid = REASSIGN_DIMENSIONS(ncid)
-    ncid = CREATE_BOUNDS(ncid)
-
-    # Create time bounds
-    #-------------------------------------------------------------------------#
-    ncid = ADD_TIME_ATTRS(ncid)
-    ncid = ASSIGN_TIME_BOUNDS(ncid)
-
-
-    # Add UTM and geographic coordinate
-    #-------------------------------------------------------------------------#
-    # Projection: universal transversal mercator
-    projection = Proj(proj='utm',zone=32,ellps='WGS84', preserve_units=False)
-    ncid       = GEOCOORDINATES(ncid, projection, use_own_REF, XREF, YREF)
-    #ncid       = GEOCOORDINATES_VECTOR(ncid, projection, use_own_REF, XREF, YREF)  # optional
-    ncid       = SET_ijk_TO_xyz(ncid)
-    ncid       = CELL_METHODS(ncid)
-    #ncid       = ADD_CELL_METHODS(ncid)    # optional
-
-
-    # Select Output Variables
-    #-------------------------------------------------------------------------#
-    ncoutput = SELECT_OUTPUT_VARIABLES(ncid, custom_variables)
-    ncoutput = ADD_CUSTOM_ATTRIBUTES_TO_VARIABLES(ncoutput)
-    ncoutput = CORRECTION_VARIABLE_ATTRIBUTES(ncoutput)
-
-
-    # Global Attributes
-    #-------------------------------------------------------------------------#
-    ncoutput.attrs            = ADD_GLOBAL_ATTRS(metadata)
-    ncoutput.attrs['history'] = ADD_GLOBAL_HISTORY_ATTRS(path + infile)
-    ncoutput                  = DELETE_GLOBAL_ATTRS(ncoutput)
-
-    # OPTIONAL: Grid Mapping and Projection (TODO)
-    #-------------------------------------------------------------------------#
-    #! INFO: only required if lat, lon are not in the dataset.
-    #! See more info at the function.
-    # XARR = GRID_MAPPING(XARR, PROJECTION) <---- WIP
-
-
-    #==============================================================================
-    # save file, end processing:
-    #-------------------------------------------------------------------------#
-    # dividing file into chunks ( useful for limited memory)
-    #rechunked = ncoutput.chunk({'i': 400, 'j': 400}) #    3 min
-    rechunked = ncoutput.chunk({'x': 400, 'y': 400}) #    3 min
-    write_job = rechunked.to_netcdf(path + outfile, compute=False, engine='netcdf4')
-    with ProgressBar():
-        print(f" INFO: Writing to {outfile}")
-        write_job.compute()
-    ncid.close()
-    ncoutput.close()
-    #-------------------------------------------------------------------------#
-    print('Finished \n file can be found here:\n ' + path + outfile)
+settings = {'use_own_REF'      : use_own_REF,
+            'XREF'             : XREF,
+            'YREF'             : YREF,
+            'use_own_ijk'      : use_own_ijk,
+            'use_own_bbox'     : use_own_bbox,
+            'bbox'             : bbox,
+            'regions'          : regions,
+            'ii'               : ii,
+            'jj'               : jj,
+            'kk'               : kk,
+            'use_timestep'     : use_timestep,
+            'tt'               : tt,
+            'custom_variables' : custom_variables,
+            'chunk_MB'         : chunk_MB,
+            'memory_MB'        : memory_MB,
+            'time_slab'        : time_slab,
+            'use_mmap'         : use_mmap,
+            'use_encoding_profiles' : use_encoding_profiles,
+            'encoding_report'       : encoding_report,
+            'output_format'         : output_format,
+            'zarr_to_netcdf'        : zarr_to_netcdf,
+            'projection'            : projection,
+            'cache_dir'             : cache_dir,
+            'use_coordinate_cache'  : use_coordinate_cache,
+            'instrumentation'       : instrumentation,
+            'instrument_log'        : instrument_log,
+            'manifest'              : manifest,
+            'time_averaging'        : time_averaging,
+            'time_label'            : time_label,
+            'continuous_time'       : continuous_time,
+            'aggregation'           : aggregation,
+            'concatenate'           : concatenate,
+            'concat_name'           : concat_name,
+            'concat_outputs'        : concat_outputs,
+            'open_threads'          : nworkers,
+            'pipeline_depth'        : pipeline_depth,
+            'partition'             : partition,
+            'partition_workers'     : partition_workers}
+
+
+if __name__ == '__main__':
+    if metadata_only:
+        # attributes of the existing outputs only, in place
+        UPDATE_METADATA_FILES(path, files, metadata, settings, nworkers)
+    elif concatenate:
+        # one run split into several files: one continuous output
+        PROCESS_RUN(path, files, metadata, settings)
+    elif use_parallel:
+        # batch mode: one file per worker, failures are reported at the end
+        PROCESS_FILES_PARALLEL(path, files, metadata, settings, nworkers, memory_limit, nthreads)
+    else:
+        PROCESS_FILES(path, files, metadata, settings)
 
 
 ###############################################################################
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+###############################################################################
+#               nc2atmodat/test_functions.py
+###############################################################################
+#
+# Regression tests for functions.py on small synthetic files
+# (create_synthetic_data.py). Run with: python -m pytest -q
+#
+#=============================================================================#
+
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from functions import *
+from create_synthetic_data import CREATE_SYNTHETIC_DATASET, WRITE_SYNTHETIC_FILE
+
+here     = os.path.dirname(os.path.abspath(__file__))
+metadata = os.path.join(here, 'Metadata_for_atmodat_standard.xlsx')
+
+
+@pytest.fixture
+def settings(tmp_path):
+    """
+    User input of process_model_data.py for the synthetic grid (reference point at elam, ephi).
+    """
+    return {'use_own_REF' : True, 'XREF' : 565946.0, 'YREF' : 5933915.5,
+            'use_own_ijk' : False, 'ii' : [0, 0], 'jj' : [0, 0], 'kk' : [0, 0],
+            'use_timestep' : False, 'tt' : [0, 0], 'custom_variables' : [],
+            'projection' : {'proj' : 'utm', 'zone' : 32, 'ellps' : 'WGS84', 'preserve_units' : False},
+            'chunk_MB' : 0.05, 'memory_MB' : None, 'manifest' : None,
+            'cache_dir' : str(tmp_path / 'cache') + '/', 'use_coordinate_cache' : True,
+            'encoding_report' : False}
+
+
+def SYNTHETIC_FILES(PATH, N, NT=3, DT='10min'):
+    """
+    N small synthetic files with consecutive time steps in PATH.
+    """
+    files = []
+    for n in range(N):
+        start = pd.Timestamp('2021-06-01') + n * NT * pd.Timedelta(DT)
+        files.append('synthetic{}.nc'.format(n))
+        WRITE_SYNTHETIC_FILE(os.path.join(PATH, files[-1]), NI=20, NJ=16, NK=8, NT=NT,
+                             N3D=1, N4D=2, NUNUSED=1, START=start, DT=DT)
+    return files
+
+
+def test_partitions_default_settings(tmp_path, settings):
+    # several files, the partition writer processes start while dask threads are alive
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 3)
+    results = PROCESS_FILES(path, files, metadata, dict(settings, partition=2))
+    assert [result['status'] for result in results] == ['done'] * 3
+    for infile, result in zip(files, results):
+        assert len(result['outfile']) == 2
+        parts = xr.open_mfdataset([path + outfile for outfile in result['outfile']])
+        assert parts.sizes['time'] == 3
+        parts.close()
+
+
+def test_partition_names_unique(tmp_path, settings):
+    # time steps of 20 s: several partitions start in the same minute
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 1, NT=6, DT='20s')
+    results = PROCESS_FILES(path, files, metadata, dict(settings, partition=1))
+    assert len(set(results[0]['outfile'])) == 6
+    assert len(glob.glob(path + 'nc2atmodat_synthetic0_*.nc')) == 6
+
+
+def test_orography_chunks(tmp_path, settings):
+    # the one-level chunks of VERTICAL_INTERFACES do not reach the planned chunks, z_bnds is float32
+    path = str(tmp_path) + '/'
+    WRITE_SYNTHETIC_FILE(path + 'hill.nc', NI=20, NJ=16, NK=8, NT=3, N3D=1, N4D=2, NUNUSED=0, OROGRAPHY=True)
+    results = PROCESS_FILES(path, ['hill.nc'], metadata, settings)
+    with xr.open_dataset(path + results[0]['outfile']) as outfile:
+        assert outfile['z_bnds'].encoding['chunksizes'] == (outfile.sizes['k'], outfile.sizes['y'], outfile.sizes['x'], 2)
+        assert outfile['treal'].encoding['chunksizes'][1] == outfile.sizes['k']
+        assert outfile['z_bnds'].encoding['dtype'] == np.dtype('float32')
+        # interfaces of the cells (default crop: cells 1 ... -3 of the input)
+        with xr.open_dataset(path + 'hill.nc') as infile:
+            zvmet = infile.zvmet.values[:, 1:-2, 1:-2]
+        nk = outfile.sizes['k']
+        np.testing.assert_allclose(outfile['z_bnds'].values[..., 0], zvmet[:nk], rtol=1e-6)
+        np.testing.assert_allclose(outfile['z_bnds'].values[..., 1], zvmet[1:nk+1], rtol=1e-6)
+        np.testing.assert_allclose(outfile['zsmet'].values, 0.5 * (zvmet[:nk] + zvmet[1:nk+1]), rtol=1e-6)
+
+
+def test_manifest_config(settings):
+    # encoding settings and the dictionaries are part of the configuration hash
+    config = MANIFEST_CONFIG(metadata, settings)
+    for key in ['use_encoding_profiles', 'time_slab']:
+        assert MANIFEST_CONFIG(metadata, dict(settings, **{key : 1}))['hash'] != config['hash']
+    for module in manifest_dictionaries:
+        assert config[module + '_sha1'] == FILE_HASH(os.path.join(here, module + '.py'))
+    assert config['functions_sha1'] == FILE_HASH(os.path.join(here, 'functions.py'))
+
+
+def test_manifest_resume(tmp_path, settings):
+    # up to date files are skipped, changed settings or inputs are converted again
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 2)
+    settings = dict(settings, manifest=path + 'manifest.json')
+    assert [result['file'] for result in PROCESS_FILES(path, files, metadata, settings)] == files
+    assert PROCESS_FILES(path, files, metadata, settings) == []
+
+    WRITE_SYNTHETIC_FILE(path + files[1], NI=20, NJ=16, NK=8, NT=4, N3D=1, N4D=2, NUNUSED=1)
+    assert [result['file'] for result in PROCESS_FILES(path, files, metadata, settings)] == files[1:]
+
+    settings['use_encoding_profiles'] = False
+    assert [result['file'] for result in PROCESS_FILES(path, files, metadata, settings)] == files
+
+
+def test_instrumentation_records(tmp_path, settings):
+    # stage and file records carry process-wide counters, labelled as such
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 1)
+    results = PROCESS_FILES(path, files, metadata, dict(settings, instrumentation=True,
+                                                        instrument_log=path + 'instrument.jsonl'))
+    record = results[0]['record']
+    assert record['counters'] == 'process'
+    assert all(stage['counters'] == 'process' for stage in record['stages'])
+    with open(path + 'instrument.jsonl') as fid:
+        assert [json.loads(line)['type'] for line in fid] == ['file', 'batch']
+
+
+def test_plan_chunks_dask_threads():
+    # the memory budget is shared by the dask threads of the process, not by all cpus
+    import dask
+    XARR = CREATE_SYNTHETIC_DATASET(NI=100, NJ=100, NK=40, NT=4, N3D=0, N4D=1, NUNUSED=0)[['treal']]
+    with dask.config.set(num_workers=1):
+        one, _ = PLAN_CHUNKS(XARR, CHUNK_MB=16, MEMORY_MB=2)
+    with dask.config.set(num_workers=4):
+        four, _ = PLAN_CHUNKS(XARR, CHUNK_MB=16, MEMORY_MB=2)
+    assert one == PLAN_CHUNKS(XARR, CHUNK_MB=16, MEMORY_MB=2, NTHREADS=1)[0]
+    assert np.prod(list(one.values())) > np.prod(list(four.values()))
+
+
+def test_grid_fingerprint_interior(capsys):
+    # a small hill away from the corners and the centre is a different grid
+    flat = CREATE_SYNTHETIC_DATASET(NI=20, NJ=16, NK=8, NT=1, N3D=0, N4D=0, NUNUSED=0)
+    hill = flat.copy(deep=True)
+    hill['yzsurf'][3, 4] = 5.
+    hill['zvmet'][:, 3, 4] += 5.
+    assert GRID_FINGERPRINT(flat) != GRID_FINGERPRINT(hill)
+    grid_profile_cache.clear()
+    assert GRID_PROFILE(flat)['orography'] is False
+    assert GRID_PROFILE(hill)['orography'] is True
+    # same domain: profile from the cache
+    capsys.readouterr()
+    assert GRID_PROFILE(flat.copy(deep=True))['orography'] is False
+    assert 'grid profile taken from cache' in capsys.readouterr().out
+
+
+def test_regions_domain_edge(tmp_path, settings):
+    # regions reaching the last cells of the grid equal separate runs of the same crop (incl. bounds)
+    path = str(tmp_path) + '/'
+    os.mkdir(path + 'single')
+    for folder in [path, path + 'single/']:
+        WRITE_SYNTHETIC_FILE(folder + 'hill.nc', NI=20, NJ=16, NK=8, NT=2, N3D=1, N4D=1, NUNUSED=0, OROGRAPHY=True)
+    regions = {'a' : {'ii' : [2, 12], 'jj' : [0, 15], 'kk' : [1, 7]},
+               'b' : {'ii' : [8, 19], 'jj' : [3, 10], 'kk' : [0, 6]}}
+    outfiles = PROCESS_FILES(path, ['hill.nc'], metadata, dict(settings, regions=regions))[0]['outfile']
+    for (name, region), outfile in zip(regions.items(), outfiles):
+        single = PROCESS_FILES(path + 'single/', ['hill.nc'], metadata,
+                               dict(settings, use_own_ijk=True, **region))[0]['outfile']
+        with xr.open_dataset(path + outfile) as part, xr.open_dataset(path + 'single/' + single) as whole:
+            assert 'z_bnds' in part.variables
+            xr.testing.assert_equal(part, whole)
+
+    # the last cell is a boundary cell, as for the default crop
+    with pytest.raises(SystemExit):
+        PROCESS_FILES(path, ['hill.nc'], metadata, dict(settings, regions={'a' : {'kk' : [1, 8]}}))
+
+
+def test_aggregation_windows(tmp_path, settings):
+    # instantaneous values every 10 minutes from 00:00 to 01:10: two complete 30min windows,
+    # the third (01:00-01:30, 2 of 3 time steps) is incomplete and dropped
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 1, NT=8)
+    aggregation = {'windows' : ['30min'], 'methods' : ['mean', 'max'], 'label' : 'end'}
+    outfiles = PROCESS_FILES(path, files, metadata, dict(settings, aggregation=aggregation))[0]['outfile']
+    assert outfiles[1:] == ['nc2atmodat_30min_mean_synthetic0.nc', 'nc2atmodat_30min_max_synthetic0.nc']
+    with xr.open_dataset(path + outfiles[0]) as full, xr.open_dataset(path + outfiles[1]) as mean, \
+         xr.open_dataset(path + outfiles[2]) as maximum:
+        starts = pd.to_datetime(['2021-06-01 00:00', '2021-06-01 00:30'])
+        np.testing.assert_array_equal(mean.time_bnds.values[:, 0], starts.values)
+        np.testing.assert_array_equal(mean.time_bnds.values[:, 1], (starts + pd.Timedelta('30min')).values)
+        np.testing.assert_array_equal(mean.time.values, mean.time_bnds.values[:, 1])
+        for n in range(2):
+            window = full.treal.isel(time=slice(3 * n, 3 * n + 3))
+            np.testing.assert_allclose(mean.treal.isel(time=n), window.mean('time'), rtol=1e-6)
+            np.testing.assert_allclose(maximum.treal.isel(time=n), window.max('time'))
+        assert mean.treal.attrs['cell_methods'].startswith('time: mean (interval: 10 minutes)')
+        assert mean.attrs['frequency'] == '1800s'
+
+
+def test_aggregation_averaged_input(tmp_path, settings):
+    # averages over the 10 minutes before each time stamp: 00:10 ... 01:00 form the window 00:00-01:00
+    path  = str(tmp_path) + '/'
+    WRITE_SYNTHETIC_FILE(path + 'averaged.nc', NI=20, NJ=16, NK=8, NT=6, N3D=1, N4D=1, NUNUSED=0,
+                         START='2021-06-01 00:10')
+    aggregation = {'windows' : ['1h'], 'methods' : ['mean']}
+    outfiles = PROCESS_FILES(path, ['averaged.nc'], metadata, dict(settings, aggregation=aggregation,
+                                                                    time_averaging='10min', time_label='end'))[0]['outfile']
+    with xr.open_dataset(path + outfiles[1]) as mean:
+        assert mean.sizes['time'] == 1
+        np.testing.assert_array_equal(mean.time_bnds.values[0], pd.to_datetime(['2021-06-01 00:00', '2021-06-01 01:00']).values)
+
+
+def test_metadata_only(tmp_path, settings):
+    # attributes are updated in place, the data stays, aggregated products keep their frequency
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 1, NT=6)
+    aggregation = {'windows' : ['30min'], 'methods' : ['mean']}
+    settings = dict(settings, aggregation=aggregation)
+    outfiles = PROCESS_FILES(path, files, metadata, settings)[0]['outfile']
+    with xr.open_dataset(path + outfiles[0]) as full:
+        expected  = full.treal.values
+        frequency = full.attrs['frequency']
+        title     = full.attrs['title']
+
+    # outdated attributes and a history edited by hand
+    import netCDF4
+    for outfile in outfiles:
+        with netCDF4.Dataset(path + outfile, 'r+') as ncfile:
+            ncfile.setncattr('history', 'edited')
+            ncfile.setncattr('title', 'outdated')
+
+    results = UPDATE_METADATA_FILES(path, files, metadata, settings, NWORKERS=2)
+    assert [result['status'] for result in results] == ['done'] * 2
+    with xr.open_dataset(path + outfiles[0]) as full, xr.open_dataset(path + outfiles[1]) as mean:
+        assert full.attrs['title'] == mean.attrs['title'] == title
+        assert full.attrs['history'].startswith('edited\n')
+        np.testing.assert_array_equal(full.treal.values, expected)
+        assert full.attrs['frequency'] == frequency
+        assert 'aggregation' not in full.attrs
+        assert mean.attrs['frequency'] == '1800s'
+        assert mean.attrs['aggregation'] == '30min mean'
+
+
+def test_benchmark_records(tmp_path, settings):
+    # the total record holds the increase of the peak memory like the stages, regressions need min_seconds
+    import benchmark_stages
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 1)
+    records = benchmark_stages.RUN_STAGES(path, files[0], metadata, settings)
+    total = records[-1]
+    assert total['stage'] == 'total'
+    assert 0 <= total['peak_rss_delta_MB'] <= total['peak_rss_MB']
+
+    previous = [{'preset' : 'small', 'stage' : 'A', 'wall_s' : 0.01}, {'preset' : 'small', 'stage' : 'B', 'wall_s' : 0.3}]
+    current  = [{'preset' : 'small', 'stage' : 'A', 'wall_s' : 0.2}, {'preset' : 'small', 'stage' : 'B', 'wall_s' : 0.6}]
+    assert [rec['stage'] for rec in benchmark_stages.CHECK_REGRESSIONS(current, previous)] == ['B']
+
+
+def test_parallel_batch(tmp_path, settings):
+    # spawned batch workers give the same outputs as the sequential conversion
+    path  = str(tmp_path) + '/'
+    os.mkdir(path + 'sequential')
+    files = SYNTHETIC_FILES(path, 2)
+    SYNTHETIC_FILES(path + 'sequential/', 2)
+    results = PROCESS_FILES_PARALLEL(path, files, metadata, settings, NWORKERS=2)
+    assert sorted(result['status'] for result in results) == ['done', 'done']
+    PROCESS_FILES(path + 'sequential/', files, metadata, settings)
+    for infile in files:
+        with xr.open_dataset(path + 'nc2atmodat_' + infile) as parallel, \
+             xr.open_dataset(path + 'sequential/nc2atmodat_' + infile) as sequential:
+            xr.testing.assert_equal(parallel, sequential)
+
+
+def test_geocoordinates_cache(capsys):
+    # the cache key comes from the grid profile: a cached grid is not computed again
+    import dask.array as da
+    projection = GET_PROJECTION({'proj' : 'utm', 'zone' : 32, 'ellps' : 'WGS84', 'preserve_units' : False})
+    XARR = CREATE_SYNTHETIC_DATASET(NI=20, NJ=16, NK=8, NT=1, N3D=0, N4D=0, NUNUSED=0)
+    profile = GRID_PROFILE(XARR)
+    first = GEOCOORDINATES(XARR.copy(), projection, True, 565946.0, 5933915.5, PROFILE=profile)
+
+    def FAIL(BLOCK):
+        raise AssertionError('lon, lat computed')
+    poisoned = XARR.copy()
+    for var in ['lon', 'lat']:
+        poisoned[var] = (('j', 'i'), da.from_array(XARR[var].values, chunks=8).map_blocks(FAIL, dtype='f8'))
+    capsys.readouterr()
+    second = GEOCOORDINATES(poisoned, projection, True, 565946.0, 5933915.5, PROFILE=profile)
+    assert 'lon, lat taken from cache' in capsys.readouterr().out
+    np.testing.assert_array_equal(second.lat.values, first.lat.values)
+
+    # other reference point: other key
+    third = GEOCOORDINATES(XARR.copy(), projection, True, 566946.0, 5933915.5, PROFILE=profile)
+    assert not np.allclose(third.lon.values, first.lon.values)
+
+    # missing lon, lat: skipped with a message, other errors are raised
+    assert 'x_utm' not in GEOCOORDINATES(XARR.drop_vars(['lon', 'lat']), projection, True, 0., 0.).variables
+    with pytest.raises(TypeError):
+        GEOCOORDINATES(XARR.copy(), projection, True, 'x', 0., PROFILE=profile)
+
+
+def test_encoding_profiles(tmp_path, settings):
+    # met fields float32 compressed with fill value, coordinates without fill value, profiles can be switched off
+    import netCDF4
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 1)
+    outfile = PROCESS_FILES(path, files, metadata, settings)[0]['outfile']
+    with netCDF4.Dataset(path + outfile) as ncfile:
+        for var in ['treal', 'tbuisurf_p']:
+            assert ncfile[var].dtype == np.float32
+            assert ncfile[var].filters()['zlib'] and ncfile[var].filters()['shuffle']
+            assert ncfile[var].filters()['complevel'] == 4
+            assert '_FillValue' in ncfile[var].ncattrs()
+        assert '_FillValue' not in ncfile['lat'].ncattrs()
+        assert ncfile['lat'].dtype == np.float64
+
+    outfile = PROCESS_FILES(path, files, metadata, dict(settings, use_encoding_profiles=False))[0]['outfile']
+    with netCDF4.Dataset(path + outfile) as ncfile:
+        assert not ncfile['treal'].filters()['zlib']
+
+
+def test_zarr_output(tmp_path, settings):
+    # the zarr store has the data and attributes of the netCDF output
+    pytest.importorskip('zarr')
+    path  = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 1)
+    ncfile = PROCESS_FILES(path, files, metadata, settings)[0]['outfile']
+    store  = PROCESS_FILES(path, files, metadata, dict(settings, output_format='zarr'))[0]['outfile']
+    assert store == 'nc2atmodat_synthetic0.zarr' and not os.path.exists(path + store + '.part')
+    with xr.open_dataset(path + ncfile) as netcdf, xr.open_zarr(path + store, consolidated=True) as zarr:
+        xr.testing.assert_equal(zarr, netcdf)
+        assert zarr.treal.attrs == netcdf.treal.attrs
+        assert zarr.attrs['title'] == netcdf.attrs['title']
+
+
+def test_time_slab(tmp_path, settings):
+    # streaming in slabs (last slab incomplete) equals writing all time steps at once
+    path = str(tmp_path) + '/'
+    os.mkdir(path + 'slabs')
+    files = SYNTHETIC_FILES(path, 1, NT=5)
+    SYNTHETIC_FILES(path + 'slabs/', 1, NT=5)
+    whole  = PROCESS_FILES(path, files, metadata, settings)[0]['outfile']
+    streamed = PROCESS_FILES(path + 'slabs/', files, metadata, dict(settings, time_slab=2))[0]['outfile']
+    with xr.open_dataset(path + whole) as ref, xr.open_dataset(path + 'slabs/' + streamed) as out:
+        xr.testing.assert_equal(out, ref)
+        assert out.encoding['unlimited_dims'] == {'time'}
+
+
+def test_bbox_crop(tmp_path, settings):
+    # a bounding box in model or UTM coordinates gives the same output as the equivalent ijk crop
+    path = str(tmp_path) + '/'
+    for folder in ['ijk', 'model', 'utm']:
+        os.mkdir(path + folder)
+        SYNTHETIC_FILES(path + folder + '/', 1)
+    # cell centres -5, 5, 15, ... m: i = 4 ... 10, j = 2 ... 6 (+ boundary cells), k without z: default
+    ijk = PROCESS_FILES(path + 'ijk/', ['synthetic0.nc'], metadata,
+                        dict(settings, use_own_ijk=True, ii=[3, 12], jj=[1, 8], kk=[0, 7]))[0]['outfile']
+    boxes = {'model' : {'crs' : 'model', 'x' : [30., 100.], 'y' : [10., 60.]},
+             'utm'   : {'crs' : 'utm', 'x' : [settings['XREF'] + 30., settings['XREF'] + 100.],
+                        'y' : [settings['YREF'] + 10., settings['YREF'] + 60.]}}
+    for folder, box in boxes.items():
+        outfile = PROCESS_FILES(path + folder + '/', ['synthetic0.nc'], metadata,
+                                dict(settings, use_own_bbox=True, bbox=box))[0]['outfile']
+        with xr.open_dataset(path + folder + '/' + outfile) as out, xr.open_dataset(path + 'ijk/' + ijk) as ref:
+            xr.testing.assert_equal(out, ref)
+
+
+def test_concatenate(tmp_path, settings):
+    # a run split into two files gives the same output as the files converted one by one
+    path = str(tmp_path) + '/'
+    files = SYNTHETIC_FILES(path, 2)
+    single = [result['outfile'] for result in
+              PROCESS_FILES(path, files, metadata, dict(settings, continuous_time=True))]
+    run = PROCESS_RUN(path, files, metadata, dict(settings, concatenate=True, concat_name='run.nc', concat_outputs=1))
+    assert run == 'nc2atmodat_run.nc'
+    with xr.open_mfdataset([path + outfile for outfile in single], data_vars='minimal') as ref, \
+         xr.open_dataset(path + run) as out:
+        assert out.sizes['time'] == 6
+        xr.testing.assert_equal(out, ref.load())
+
+    split = PROCESS_RUN(path, files, metadata, dict(settings, concatenate=True, concat_name='run.nc', concat_outputs=2))
+    assert split == ['nc2atmodat_run_01.nc', 'nc2atmodat_run_02.nc']
+    with xr.open_dataset(path + split[1]) as part, xr.open_dataset(path + single[1]) as ref:
+        xr.testing.assert_equal(part, ref)